@@ -0,0 +1,20 @@
+"""Import friend-management-api.py from other entry points (asgi.py and the
+benchmark), as its file name is not a valid module name.
+"""
+import importlib.util
+import os
+
+
+API_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "friend-management-api.py"
+)
+
+
+def load_api_module():
+    """Import friend-management-api.py, whose name is not a valid module name"""
+    spec = importlib.util.spec_from_file_location("friend_management_api",
+        API_PATH
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,188 @@
+"""ASGI entry point for friend-management-api.py, e.g. `uvicorn asgi:app`.
+
+The Flask app runs unchanged, through its WSGI interface, on a bounded pool
+of ASGI_MAX_THREADS threads, and with it every SQLite call. The event loop
+receives each request body and sends each response, so a slow client holds
+a connection but no thread while uploading or downloading, and requests
+beyond the pool's size wait in its queue. One process can then keep
+thousands of requests in flight with a few dozen threads.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import io
+import sys
+import threading
+
+from api_module import load_api_module
+
+
+class AsgiAdapter:
+    def __init__(self, wsgi_app, max_threads):
+        """Serve wsgi_app, calling it and reading its responses on a pool of
+        max_threads threads
+        """
+        self.wsgi_app = wsgi_app
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_threads,
+            thread_name_prefix="asgi"
+        )
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "in_flight": 0}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["in_flight"] += 1
+        try:
+            await self._http(scope, receive, send)
+        finally:
+            with self._lock:
+                self._stats["in_flight"] -= 1
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await asyncio.get_running_loop().run_in_executor(None,
+                    self.executor.shutdown
+                )
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        # The whole body is read before the app sees it, so that no thread
+        # waits on the client
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        # Every step runs in the same context, as the app keeps its request
+        # context in context variables while a streamed body is generated
+        context = contextvars.Context()
+        status, headers, chunk, body = await self._run(context, self._start,
+            environ_of(scope, b"".join(chunks))
+        )
+        try:
+            await send({"type": "http.response.start", "status": status,
+                "headers": headers
+            })
+            while chunk is not None:
+                await send({"type": "http.response.body", "body": chunk,
+                    "more_body": True
+                })
+                # Streamed bodies are generated on the pool too, a chunk at a
+                # time, as they may read from the database
+                chunk = await self._run(context, self._next, body)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            # e.g. the client disconnected
+            if chunk is not None:
+                await self._run(context, self._close, body)
+
+    async def _run(self, context, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor,
+            context.run, func, *args
+        )
+
+    def _start(self, environ):
+        """Call the app; returns (status, headers, first chunk or None, body),
+        where body is the (iterable, iterator) pair of the response body,
+        closed already if there is no first chunk
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]
+            return response.setdefault("written", []).append
+
+        iterable = self.wsgi_app(environ, start_response)
+        body = (iterable, iter(iterable))
+        try:
+            chunk = self._next(body)
+        except BaseException:
+            self._close(body)
+            raise
+        # Bodies written the deprecated way, through write(), come first
+        written = b"".join(response.get("written", []))
+        if written:
+            chunk = written + (chunk or b"")
+        return response["status"], response["headers"], chunk, body
+
+    def _next(self, body):
+        """Next non-empty chunk of body, or None once exhausted, closing it"""
+        _, iterator = body
+        for chunk in iterator:
+            if chunk:
+                return chunk
+        self._close(body)
+        return None
+
+    def _close(self, body):
+        iterable, _ = body
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def environ_of(scope, body):
+    """WSGI environ of an ASGI http scope with the given request body"""
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode().decode("latin-1"),
+        "PATH_INFO": path.encode().decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = (
+            scope["client"][0], str(scope["client"][1])
+        )
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = name if name == "CONTENT_TYPE" else f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+api = load_api_module()
+app = AsgiAdapter(api.app, api.app.config["ASGI_MAX_THREADS"])
+
+api.registry.gauge_collector("asgi",
+    "ASGI adapter counters, by statistic", "stat", app.stats
+)
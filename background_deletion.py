@@ -0,0 +1,56 @@
+"""Delete large amounts of data a small batch at a time, on a thread of its own.
+
+Each batch is deleted in a transaction of its own and followed by a pause, so
+that a deletion touching millions of rows holds the database's write lock for
+a moment at a time, and the writes of other requests get through in between.
+"""
+import threading
+import time
+
+
+class BackgroundDeleter:
+    def __init__(self, delete_batch, batch_delay):
+        """delete_batch is called on the deleter thread, and deletes one batch,
+        returning False once there is nothing left to delete. Batches are
+        deleted batch_delay seconds apart until then, and again after the next
+        call to wake.
+        """
+        self.delete_batch = delete_batch
+        self.batch_delay = batch_delay
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"wakeups": 0, "batches": 0, "failed_batches": 0}
+
+    def wake(self):
+        """Start deleting, if not already, e.g. after queueing a deletion"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name="background-deleter", daemon=True
+                )
+                self._thread.start()
+            self._stats["wakeups"] += 1
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                try:
+                    more = self.delete_batch()
+                except Exception:
+                    # Left for the next wake, rather than retried in a loop
+                    with self._lock:
+                        self._stats["failed_batches"] += 1
+                    break
+                if not more:
+                    break
+                with self._lock:
+                    self._stats["batches"] += 1
+                time.sleep(self.batch_delay)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,19 @@
+"""Load benchmark for the friend management API.
+
+Builds a users.db filled with a synthetic power-law social graph, drives every
+route of friend-management-api.py and reports throughput and latency
+percentiles per endpoint as JSON. See `python -m benchmark --help`.
+"""
+import os
+import runpy
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_schema_module():
+    """Get the globals of db-structure.py without running its main block"""
+    return runpy.run_path(os.path.join(REPO_DIR, "db-structure.py"),
+        run_name="db_structure"
+    )
+
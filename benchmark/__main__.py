@@ -0,0 +1,178 @@
+"""Command line entry point: python -m benchmark {run,compare} ..."""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+from api_module import load_api_module
+from benchmark import REPO_DIR
+from benchmark.graph import SyntheticGraph
+from benchmark.runner import HttpClient, Scenarios, TestClient, run
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def app_routes(app):
+    """Routes of the app as "METHOD /path", excluding Flask's own"""
+    return {
+        f"{method} {rule.rule}"
+        for rule in app.url_map.iter_rules() if rule.endpoint != "static"
+        for method in rule.methods - {"HEAD", "OPTIONS"}
+    }
+
+
+def run_benchmark(args):
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), "users.db")
+    if os.path.exists(db_path):
+        sys.exit(f"{db_path} already exists")
+    graph = SyntheticGraph(args.users, args.avg_friends, args.exponent,
+        args.subscription_ratio, args.block_ratio, args.seed
+    )
+    graph.write_db(db_path)
+    print(f"Wrote {len(graph.emails)} users, {len(graph.friends)} friendships, "
+        f"{len(graph.subscriptions)} subscriptions and {len(graph.blocks)} blocks "
+        f"to {db_path}", file=sys.stderr
+    )
+    # Passed the way the app reads its settings when it is imported, as some
+    # are used then, e.g. EMAIL_ID_CACHE_SIZE and WRITE_BATCH_MAX_SIZE
+    for setting in args.config:
+        key, value = setting.split("=", 1)
+        os.environ[f"FLASK_{key}"] = json.dumps(json.loads(value))
+    api = load_api_module()
+    api.app.config.update(DB_PATH=db_path)
+    if api.app.config["AUDIENCE_TABLE_ENABLED"]:
+        result = api.app.test_cli_runner().invoke(args=["rebuild-audience"])
+        print(result.output, end="", file=sys.stderr)
+    scenarios = Scenarios(graph)
+    routes = app_routes(api.app)
+    for route in sorted(routes - scenarios.generators().keys()):
+        print(f"No scenario for {route}, skipping", file=sys.stderr)
+    # Scenario order keeps each write next to the write that undoes it
+    routes = [route for route in scenarios.generators() if route in routes]
+    if args.routes:
+        routes = [route for route in routes if route in args.routes]
+    if args.url:
+        print(f"Serve {db_path} at {args.url} now, then press enter",
+            file=sys.stderr
+        )
+        input()
+        client = HttpClient(args.url)
+    else:
+        client = TestClient(api.app)
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "client": "http" if args.url else "test_client",
+            "graph": {
+                "users": args.users,
+                "avg_friends": args.avg_friends,
+                "exponent": args.exponent,
+                "subscription_ratio": args.subscription_ratio,
+                "block_ratio": args.block_ratio,
+                "seed": args.seed,
+            },
+            "config": args.config,
+            "requests_per_route": args.requests,
+        },
+        "endpoints": run(client, scenarios, routes, args.requests),
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+def compare(args):
+    """Print per-endpoint changes between two result files, and exit with
+    status 1 if any endpoint's p95 latency regressed by more than threshold
+    """
+    with open(args.baseline) as f:
+        baseline = json.load(f)["endpoints"]
+    with open(args.current) as f:
+        current = json.load(f)["endpoints"]
+    regressed = False
+    for route in sorted(baseline.keys() & current.keys()):
+        changes = []
+        for metric in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms"):
+            old, new = baseline[route][metric], current[route][metric]
+            change = (new - old) / old if old else 0.0
+            changes.append(f"{metric} {old} -> {new} ({change:+.1%})")
+            if metric == "p95_ms" and change > args.threshold:
+                regressed = True
+                changes[-1] += " REGRESSION"
+        print(f"{route}: " + ", ".join(changes))
+    for route in sorted(baseline.keys() ^ current.keys()):
+        print(f"{route}: only in {'baseline' if route in baseline else 'current'}")
+    sys.exit(1 if regressed else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark",
+        description=__doc__
+    )
+    subparsers = parser.add_subparsers(required=True)
+
+    run_parser = subparsers.add_parser("run",
+        help="generate a graph, drive every route and report latencies"
+    )
+    run_parser.add_argument("--users", type=int, default=10000)
+    run_parser.add_argument("--avg-friends", type=int, default=20)
+    run_parser.add_argument("--exponent", type=float, default=2.5,
+        help="power-law exponent of the degree distribution"
+    )
+    run_parser.add_argument("--subscription-ratio", type=float, default=0.5,
+        help="subscriptions per friendship"
+    )
+    run_parser.add_argument("--block-ratio", type=float, default=0.05,
+        help="blocks per friendship"
+    )
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--requests", type=int, default=500,
+        help="requests per route"
+    )
+    run_parser.add_argument("--routes", nargs="*",
+        help='only these routes, e.g. "GET /friend_list"'
+    )
+    run_parser.add_argument("--config", nargs="*", default=[],
+        metavar="KEY=JSON", help="app config overrides, e.g. GRAPH_ENGINE_ENABLED=true"
+    )
+    run_parser.add_argument("--db", help="path for the generated database "
+        "(default: a new temporary directory)"
+    )
+    run_parser.add_argument("--url", help="benchmark a server at this URL "
+        "instead of using the test client"
+    )
+    run_parser.add_argument("--output", help="write results JSON here")
+    run_parser.set_defaults(func=run_benchmark)
+
+    compare_parser = subparsers.add_parser("compare",
+        help="compare two result files"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+        help="p95 latency increase counted as a regression (default 0.1 = 10%%)"
+    )
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
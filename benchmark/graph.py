@@ -0,0 +1,76 @@
+"""Synthetic social graph with a power-law degree distribution."""
+import bisect
+import itertools
+import random
+import sqlite3
+
+from benchmark import load_schema_module
+
+
+class SyntheticGraph:
+    """Users and relationships of a Chung-Lu random graph.
+
+    User i gets weight (i + 1) ** (-1 / (exponent - 1)), and each endpoint of
+    every edge is drawn with probability proportional to weight, so expected
+    degrees follow a power law with the given exponent.
+    """
+    def __init__(self, users, avg_friends, exponent=2.5, subscription_ratio=0.5,
+        block_ratio=0.05, seed=0
+    ):
+        self.rng = random.Random(seed)
+        self.emails = [f"user{i}@example.com" for i in range(users)]
+        weights = [(i + 1) ** (-1 / (exponent - 1)) for i in range(users)]
+        self._cum_weights = list(itertools.accumulate(weights))
+        n_friends = users * avg_friends // 2
+        self.friends = self._sample_pairs(n_friends, symmetric=True)
+        self.subscriptions = self._sample_pairs(
+            int(n_friends * subscription_ratio), exclude=self.friends
+        )
+        # Blocks never coexist with a friendship or subscription in the API
+        related = self.friends | self.subscriptions | {
+            (b, a) for a, b in self.friends | self.subscriptions
+        }
+        self.blocks = self._sample_pairs(int(n_friends * block_ratio),
+            exclude=related
+        )
+
+    def sample_user(self):
+        """Index of a user, drawn in proportion to expected degree"""
+        total = self._cum_weights[-1]
+        return bisect.bisect(self._cum_weights, self.rng.random() * total)
+
+    def _sample_pairs(self, count, symmetric=False, exclude=frozenset()):
+        pairs = set()
+        # Give up on duplicates eventually, for small dense graphs
+        for _ in range(count * 10):
+            if len(pairs) >= count:
+                break
+            a, b = self.sample_user(), self.sample_user()
+            if a == b:
+                continue
+            if symmetric:
+                a, b = min(a, b), max(a, b)
+            if (a, b) not in exclude:
+                pairs.add((a, b))
+        return pairs
+
+    def write_db(self, db_path):
+        """Create db_path with the current schema and fill it with the graph"""
+        schema = load_schema_module()
+        conn = sqlite3.connect(db_path)
+        schema["create_schema"](conn)
+        # email_id i + 1 is user i, since ids are assigned in insert order
+        conn.executemany("INSERT INTO email (email_id, email) VALUES (?, ?);",
+            ((i + 1, email) for i, email in enumerate(self.emails))
+        )
+        conn.executemany("INSERT INTO friend VALUES (?, ?);",
+            ((a + 1, b + 1) for a, b in self.friends)
+        )
+        conn.executemany("INSERT INTO subscription VALUES (?, ?);",
+            ((a + 1, b + 1) for a, b in self.subscriptions)
+        )
+        conn.executemany("INSERT INTO block VALUES (?, ?);",
+            ((a + 1, b + 1) for a, b in self.blocks)
+        )
+        conn.commit()
+        conn.close()
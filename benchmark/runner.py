@@ -0,0 +1,222 @@
+"""Drive every route of the API and measure per-endpoint latency."""
+import json
+import statistics
+import time
+import urllib.request
+
+
+class TestClient:
+    """Send requests in-process through Flask's test client"""
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body, content_type):
+        response = self.client.open(path, method=method, data=body,
+            content_type=content_type
+        )
+        data = response.get_data()
+        return response.status_code, data
+
+
+class HttpClient:
+    """Send requests to a running server"""
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, path, body, content_type):
+        req = urllib.request.Request(self.base_url + path, data=body,
+            method=method, headers={"Content-Type": content_type}
+        )
+        with urllib.request.urlopen(req) as response:
+            return response.status, response.read()
+
+
+class Scenarios:
+    """Request generators for each route, keyed "METHOD /path".
+
+    Each generator returns (body, content type). Write scenarios undo each
+    other in pairs (e.g. /friend then /unfriend on the same pairs, or POST
+    then DELETE /users on the same users), so the graph stays close to its
+    generated shape throughout a run.
+    """
+    BULK_ROWS = 100
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.rng = graph.rng
+        self._new_users = 0
+        self._added = {"friend": [], "subscribe": [], "block": []}
+        self._added_users = []
+        self._deleted_users = []
+
+    def email(self):
+        return self.graph.emails[self.graph.sample_user()]
+
+    def pair(self):
+        a, b = self.email(), self.email()
+        while b == a:
+            b = self.email()
+        return a, b
+
+    @staticmethod
+    def as_json(body):
+        return json.dumps(body).encode(), "application/json"
+
+    @staticmethod
+    def as_ndjson(bodies):
+        return "\n".join(json.dumps(body) for body in bodies).encode(), \
+            "application/x-ndjson"
+
+    def new_email(self):
+        self._new_users += 1
+        return f"bench-new{self._new_users}@example.com"
+
+    def add_user(self):
+        email = self.new_email()
+        self._added_users.append(email)
+        return email
+
+    def take_user(self):
+        email = self._added_users.pop() if self._added_users else self.email()
+        self._deleted_users.append(email)
+        return email
+
+    def deleted_user(self):
+        if not self._deleted_users:
+            return self.email()
+        return self.rng.choice(self._deleted_users)
+
+    def add_pair(self, kind):
+        pair = self.pair()
+        self._added[kind].append(pair)
+        return pair
+
+    def take_pair(self, kind):
+        added = self._added[kind]
+        return added.pop() if added else self.pair()
+
+    def generators(self):
+        return {
+            "GET /metrics": lambda: (None, "application/json"),
+            "GET /pool_stats": lambda: (None, "application/json"),
+            "GET /cache_stats": lambda: (None, "application/json"),
+            "GET /graph_check": lambda: (None, "application/json"),
+            "POST /users": lambda: self.as_json({"email": self.add_user()}),
+            "DELETE /users": lambda: self.as_json({"email": self.take_user()}),
+            "GET /users/deletion": lambda: self.as_json(
+                {"email": self.deleted_user()}
+            ),
+            "POST /friend": lambda: self.as_json(
+                {"friends": list(self.add_pair("friend"))}
+            ),
+            "POST /unfriend": lambda: self.as_json(
+                {"friends": list(self.take_pair("friend"))}
+            ),
+            "GET /friend_list": lambda: self.as_json({"email": self.email()}),
+            "GET /users/stats": lambda: self.as_json(
+                {"emails": [self.email() for _ in range(10)]}
+            ),
+            "GET /users/resolve": lambda: self.as_json(
+                {"emails": [self.email() for _ in range(10)]}
+            ),
+            "GET /subscribers": lambda: self.as_json({"email": self.email()}),
+            "GET /common_friends": lambda: self.as_json(
+                {"friends": list(self.pair())}
+            ),
+            "GET /suggestions": lambda: self.as_json({"email": self.email()}),
+            "POST /subscribe": lambda: self.as_json(
+                dict(zip(("requestor", "target"), self.add_pair("subscribe")))
+            ),
+            "POST /unsubscribe": lambda: self.as_json(
+                dict(zip(("requestor", "target"), self.take_pair("subscribe")))
+            ),
+            "POST /block": lambda: self.as_json(
+                dict(zip(("requestor", "target"), self.add_pair("block")))
+            ),
+            "POST /unblock": lambda: self.as_json(
+                dict(zip(("requestor", "target"), self.take_pair("block")))
+            ),
+            "GET /notified": lambda: self.as_json({
+                "sender": self.email(),
+                "text": "Hello " + " ".join(
+                    self.email() for _ in range(self.rng.randint(0, 3))
+                ),
+            }),
+            "POST /notified/batch": lambda: self.as_json([
+                {
+                    "sender": self.email(),
+                    "text": "Hello " + " ".join(
+                        self.email() for _ in range(self.rng.randint(0, 3))
+                    ),
+                }
+                for _ in range(self.BULK_ROWS)
+            ]),
+            "POST /users/bulk": lambda: self.as_ndjson(
+                {"email": self.new_email()} for _ in range(self.BULK_ROWS)
+            ),
+            "POST /friend/bulk": lambda: self.as_ndjson(
+                {"friends": list(self.pair())} for _ in range(self.BULK_ROWS)
+            ),
+            "POST /subscribe/bulk": lambda: self.as_ndjson(
+                dict(zip(("requestor", "target"), self.pair()))
+                for _ in range(self.BULK_ROWS)
+            ),
+            "POST /block/bulk": lambda: self.as_ndjson(
+                dict(zip(("requestor", "target"), self.pair()))
+                for _ in range(self.BULK_ROWS)
+            ),
+        }
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency percentiles (in milliseconds) of one endpoint"""
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    else:
+        percentiles = latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": round(percentiles[49] * 1000, 3),
+        "p95_ms": round(percentiles[94] * 1000, 3),
+        "p99_ms": round(percentiles[98] * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+    }
+
+
+def is_error(status, data):
+    if status != 200:
+        return True
+    try:
+        return json.loads(data).get("success") is False
+    except ValueError:
+        # NDJSON results of bulk endpoints, which report errors per line
+        return False
+
+
+def run(client, scenarios, routes, requests_per_route, warmup=10):
+    """Send requests_per_route requests to each route in turn; returns a dict
+    of route -> summary
+    """
+    generators = scenarios.generators()
+    results = {}
+    for route in routes:
+        method, path = route.split(" ", 1)
+        generate = generators[route]
+        for _ in range(warmup):
+            client.request(method, path, *generate())
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+        for _ in range(requests_per_route):
+            body, content_type = generate()
+            t0 = time.perf_counter()
+            status, data = client.request(method, path, body, content_type)
+            latencies.append(time.perf_counter() - t0)
+            errors += is_error(status, data)
+        results[route] = summarize(latencies, errors,
+            time.perf_counter() - started
+        )
+    return results
@@ -0,0 +1,92 @@
+"""Follow the change_log table to see writes committed by other processes.
+
+Triggers record every insert into email and deletion, and every insert into
+or delete from the relationship tables, in change_log (see db-structure.py).
+A ChangeLogFollower keeps a connection of its own and first checks its PRAGMA
+data_version, which only changes when another connection has committed, so
+that finding out nothing has changed costs no table read.
+"""
+import collections
+import threading
+
+
+# email_id2 is None and email is set for 'email' and 'deletion' changes, and
+# the other way round for the relationship tables
+Change = collections.namedtuple("Change",
+    "change_id table_name is_added email_id1 email_id2 email"
+)
+
+GET_LAST_CHANGE_ID = "SELECT COALESCE(MAX(change_id), 0) FROM change_log;"
+GET_FIRST_CHANGE_ID = "SELECT MIN(change_id) FROM change_log;"
+GET_CHANGES_AFTER = '''SELECT change_id, table_name, is_added, email_id1, email_id2, email
+    FROM change_log
+    WHERE change_id > ?
+    ORDER BY change_id
+    LIMIT ?
+    ;
+'''
+
+
+class ChangeLogFollower:
+    def __init__(self, connect, max_replay):
+        """connect opens a new sqlite3 connection, usable from any thread, to
+        the database to follow; sync drops everything instead of replaying
+        changes when more than max_replay are new
+        """
+        self.connect = connect
+        self.max_replay = max_replay
+        self._conn = None
+        self._data_version = None
+        self._last_change_id = None
+        self._lock = threading.Lock()
+        self._stats = {"polls": 0, "syncs": 0, "changes": 0, "resets": 0}
+
+    def sync(self, apply_changes, reset):
+        """Bring the caller's caches up to date with the database.
+
+        Calls apply_changes with the list of Changes committed since the last
+        sync, in commit order, or reset if they cannot all be replayed (too
+        many, or already trimmed from change_log). The first sync only notes
+        the latest change. Concurrent callers wait for the running sync, so
+        that once sync returns, the caches reflect every change committed
+        before it was called.
+        """
+        with self._lock:
+            self._stats["polls"] += 1
+            if self._conn is None:
+                self._conn = self.connect()
+                # Autocommit, so that each read sees the latest commit
+                self._conn.isolation_level = None
+            data_version = self._conn.execute("PRAGMA data_version;").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            if self._last_change_id is None:
+                self._last_change_id = self._conn.execute(
+                    GET_LAST_CHANGE_ID
+                ).fetchone()[0]
+                return
+            self._stats["syncs"] += 1
+            changes = [Change(*row) for row in self._conn.execute(
+                GET_CHANGES_AFTER, (self._last_change_id, self.max_replay + 1)
+            )]
+            if not changes:
+                return
+            first_change_id = self._conn.execute(GET_FIRST_CHANGE_ID).fetchone()[0]
+            if len(changes) > self.max_replay or (
+                first_change_id > self._last_change_id + 1
+            ):
+                self._stats["resets"] += 1
+                # Changes committed from here on are replayed on the next sync
+                self._last_change_id = self._conn.execute(
+                    GET_LAST_CHANGE_ID
+                ).fetchone()[0]
+                reset()
+                return
+            self._stats["changes"] += len(changes)
+            self._last_change_id = changes[-1].change_id
+            apply_changes(changes)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,177 @@
+"""Compact, memory-mapped snapshot of users.db for the graph engine.
+
+Each relationship table is stored in compressed sparse row form, indexed by
+email_id: an offsets array of max_email_id + 2 integers, and a neighbours
+array in which the neighbours of email_id are
+neighbours[offsets[email_id]:offsets[email_id + 1]], sorted. The emails are
+stored the same way, as UTF-8 bytes (empty for unused ids).
+
+Arrays are machine integers in native byte order, read through memoryviews of
+a read-only mmap, so loading a snapshot copies nothing and every process
+mapping the same file shares its pages.
+"""
+import array
+import mmap
+import os
+import struct
+
+
+MAGIC = b"FMCSR\x00\x00\x02"
+# email_id -> neighbour ids, read from users.db in (key, neighbour) order
+SECTIONS = {
+    "friends": '''SELECT email_id1, email_id2 FROM friend
+        UNION ALL
+        SELECT email_id2, email_id1 FROM friend
+        ORDER BY 1, 2
+        ;
+    ''',
+    "subscribers": '''SELECT target_email_id, subscriber_email_id FROM subscription
+        ORDER BY target_email_id, subscriber_email_id
+        ;
+    ''',
+    "blockers": '''SELECT blocked_email_id, blocker_email_id FROM block
+        ORDER BY blocked_email_id, blocker_email_id
+        ;
+    ''',
+}
+# Row counts stored with the snapshot, as written
+COUNTED_TABLES = ("email", "friend", "subscription", "block")
+# Byte order check, max_email_id, last change id, table row counts, then
+# (offsets position, data position, data length) for each section and the
+# emails
+HEADER = struct.Struct("=qqq4q" + "3q" * (len(SECTIONS) + 1))
+
+
+def count_rows(conn):
+    return {table: conn.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+        for table in COUNTED_TABLES
+    }
+
+
+def last_change_id(conn):
+    """Id of the latest change to the database, which tells whether it changed.
+
+    Triggers log every write to the snapshot's tables in change_log (see
+    db-structure.py), whose AUTOINCREMENT ids are never reused, even once
+    trimmed, unlike row counts, which e.g. an unfriend and a befriend leave
+    as they were.
+    """
+    row = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'change_log';"
+    ).fetchone()
+    return row[0] if row is not None else 0
+
+
+def _to_csr(rows, max_email_id):
+    """Build (offsets, data) arrays from (email_id, neighbour) rows sorted by
+    email_id
+    """
+    offsets = array.array("q", bytes(8 * (max_email_id + 2)))
+    data = array.array("q")
+    for email_id, neighbour_id in rows:
+        offsets[email_id + 1] += 1
+        data.append(neighbour_id)
+    for i in range(1, len(offsets)):
+        offsets[i] += offsets[i - 1]
+    return offsets, data
+
+
+def write_snapshot(conn, path):
+    """Write a snapshot of the database open on conn to path, replacing any
+    existing snapshot atomically; returns the table row counts
+    """
+    # One read transaction, so that every table is read at the same point
+    conn.execute("BEGIN;")
+    try:
+        max_email_id = conn.execute(
+            "SELECT COALESCE(MAX(email_id), 0) FROM email;"
+        ).fetchone()[0]
+        counts = count_rows(conn)
+        change_id = last_change_id(conn)
+        arrays = [_to_csr(conn.execute(query), max_email_id)
+            for query in SECTIONS.values()
+        ]
+        email_offsets = array.array("q", bytes(8 * (max_email_id + 2)))
+        email_data = bytearray()
+        for email_id, email in conn.execute(
+            "SELECT email_id, email FROM email ORDER BY email_id;"
+        ):
+            encoded = email.encode()
+            email_offsets[email_id + 1] = len(encoded)
+            email_data += encoded
+        for i in range(1, len(email_offsets)):
+            email_offsets[i] += email_offsets[i - 1]
+    finally:
+        conn.rollback()
+    # Integer arrays first, so they stay 8-byte aligned
+    position = HEADER.size
+    layout = []
+    for offsets, data in arrays + [(email_offsets, email_data)]:
+        data_position = position + len(offsets) * offsets.itemsize
+        layout.append((position, data_position, len(data)))
+        position = data_position + len(data) * getattr(data, "itemsize", 1)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER.pack(1, max_email_id, change_id,
+            *(counts[table] for table in COUNTED_TABLES),
+            *(value for section in layout for value in section)
+        ))
+        for offsets, data in arrays + [(email_offsets, email_data)]:
+            f.write(offsets.tobytes())
+            f.write(bytes(data) if isinstance(data, bytearray) else data.tobytes())
+    os.replace(tmp_path, path)
+    return counts
+
+
+class Snapshot:
+    """Read-only view of a snapshot file"""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a graph snapshot")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        header = HEADER.unpack_from(view, len(MAGIC))
+        if header[0] != 1:
+            raise ValueError(f"{path} was written with another byte order")
+        self.max_email_id = header[1]
+        self.last_change_id = header[2]
+        self.counts = dict(zip(COUNTED_TABLES, header[3:7]))
+        base = len(MAGIC)
+        self._sections = {}
+        for i, name in enumerate(list(SECTIONS) + ["emails"]):
+            offsets_position, data_position, length = header[7 + 3 * i:10 + 3 * i]
+            offsets = view[base + offsets_position:base + data_position].cast("q")
+            if name == "emails":
+                data = view[base + data_position:base + data_position + length]
+            else:
+                data = view[base + data_position:
+                    base + data_position + 8 * length
+                ].cast("q")
+            self._sections[name] = (offsets, data)
+        self._empty = memoryview(array.array("q"))
+
+    def neighbours(self, section, email_id):
+        """Sorted email_ids of email_id's 'friends', 'subscribers' or
+        'blockers', as a memoryview into the snapshot
+        """
+        if not 0 <= email_id <= self.max_email_id:
+            return self._empty
+        offsets, data = self._sections[section]
+        return data[offsets[email_id]:offsets[email_id + 1]]
+
+    def keys(self, section):
+        """email_ids with any neighbours in section"""
+        offsets, _ = self._sections[section]
+        return (email_id for email_id in range(self.max_email_id + 1)
+            if offsets[email_id] != offsets[email_id + 1]
+        )
+
+    def email(self, email_id):
+        """The email of email_id, or None if there is none"""
+        if not 0 <= email_id <= self.max_email_id:
+            return None
+        offsets, data = self._sections["emails"]
+        start, end = offsets[email_id], offsets[email_id + 1]
+        return str(data[start:end], "utf-8") if start != end else None
@@ -1,44 +1,223 @@
+import glob
 import sqlite3
 
 
 DB_NAME = "users.db"
-conn = sqlite3.connect(DB_NAME)
-cur = conn.cursor()
+# Stored in PRAGMA user_version; friend-management-api.py refuses to open a
+# database at any other version
+SCHEMA_VERSION = 4
 
-# DB schema
-cur.execute(
+# Keep the degree counters on email up to date
+COUNTER_TRIGGERS = [
+    "CREATE TRIGGER friend_count_insert AFTER INSERT ON friend BEGIN "
+        "UPDATE email SET friend_count = friend_count + 1 "
+        "WHERE email_id IN (NEW.email_id1, NEW.email_id2); "
+    "END;",
+    "CREATE TRIGGER friend_count_delete AFTER DELETE ON friend BEGIN "
+        "UPDATE email SET friend_count = friend_count - 1 "
+        "WHERE email_id IN (OLD.email_id1, OLD.email_id2); "
+    "END;",
+    "CREATE TRIGGER subscriber_count_insert AFTER INSERT ON subscription BEGIN "
+        "UPDATE email SET subscriber_count = subscriber_count + 1 "
+        "WHERE email_id = NEW.target_email_id; "
+    "END;",
+    "CREATE TRIGGER subscriber_count_delete AFTER DELETE ON subscription BEGIN "
+        "UPDATE email SET subscriber_count = subscriber_count - 1 "
+        "WHERE email_id = OLD.target_email_id; "
+    "END;",
+    "CREATE TRIGGER blocked_by_count_insert AFTER INSERT ON block BEGIN "
+        "UPDATE email SET blocked_by_count = blocked_by_count + 1 "
+        "WHERE email_id = NEW.blocked_email_id; "
+    "END;",
+    "CREATE TRIGGER blocked_by_count_delete AFTER DELETE ON block BEGIN "
+        "UPDATE email SET blocked_by_count = blocked_by_count - 1 "
+        "WHERE email_id = OLD.blocked_email_id; "
+    "END;",
+]
+
+# Record every change to email and the relationship tables in change_log,
+# which server processes poll to keep their caches coherent
+CHANGE_LOG_SCHEMA = [
+    "CREATE TABLE change_log ("
+        "change_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "table_name TEXT NOT NULL,"
+        "is_added INTEGER NOT NULL,"
+        "email_id1 INTEGER NOT NULL,"
+        "email_id2 INTEGER,"
+        "email TEXT"
+    ");",
+    "CREATE TRIGGER email_log_insert AFTER INSERT ON email BEGIN "
+        "INSERT INTO change_log (table_name, is_added, email_id1, email) "
+        "VALUES ('email', 1, NEW.email_id, NEW.email); "
+    "END;",
+    "CREATE TRIGGER friend_log_insert AFTER INSERT ON friend BEGIN "
+        "INSERT INTO change_log (table_name, is_added, email_id1, email_id2) "
+        "VALUES ('friend', 1, NEW.email_id1, NEW.email_id2); "
+    "END;",
+    "CREATE TRIGGER friend_log_delete AFTER DELETE ON friend BEGIN "
+        "INSERT INTO change_log (table_name, is_added, email_id1, email_id2) "
+        "VALUES ('friend', 0, OLD.email_id1, OLD.email_id2); "
+    "END;",
+    "CREATE TRIGGER subscription_log_insert AFTER INSERT ON subscription BEGIN "
+        "INSERT INTO change_log (table_name, is_added, email_id1, email_id2) "
+        "VALUES ('subscription', 1, NEW.subscriber_email_id, NEW.target_email_id); "
+    "END;",
+    "CREATE TRIGGER subscription_log_delete AFTER DELETE ON subscription BEGIN "
+        "INSERT INTO change_log (table_name, is_added, email_id1, email_id2) "
+        "VALUES ('subscription', 0, OLD.subscriber_email_id, OLD.target_email_id); "
+    "END;",
+    "CREATE TRIGGER block_log_insert AFTER INSERT ON block BEGIN "
+        "INSERT INTO change_log (table_name, is_added, email_id1, email_id2) "
+        "VALUES ('block', 1, NEW.blocker_email_id, NEW.blocked_email_id); "
+    "END;",
+    "CREATE TRIGGER block_log_delete AFTER DELETE ON block BEGIN "
+        "INSERT INTO change_log (table_name, is_added, email_id1, email_id2) "
+        "VALUES ('block', 0, OLD.blocker_email_id, OLD.blocked_email_id); "
+    "END;",
+]
+
+# Users being deleted, or deleted: reads leave out users whose deletion has
+# not finished, while their relationship rows are removed in batches. On a
+# sharded database every shard holds a copy, counting the rows removed there.
+DELETION_SCHEMA = [
+    "CREATE TABLE deletion ("
+        "email_id INTEGER PRIMARY KEY,"
+        "email TEXT NOT NULL,"
+        "requested_at REAL NOT NULL,"
+        "removed_rows INTEGER NOT NULL DEFAULT 0,"
+        "finished_at REAL"
+    ");",
+    # Pending deletions are those with a NULL finished_at
+    "CREATE INDEX deletion_pending ON deletion (finished_at, email_id);",
+    "CREATE INDEX deletion_by_email ON deletion (email, requested_at);",
+    "CREATE TRIGGER deletion_log_insert AFTER INSERT ON deletion BEGIN "
+        "INSERT INTO change_log (table_name, is_added, email_id1, email) "
+        "VALUES ('deletion', 1, NEW.email_id, NEW.email); "
+    "END;",
+]
+
+# DB schema, as of SCHEMA_VERSION
+SCHEMA = [
+    # The counts are of friends, subscribers and users blocking this user
     "CREATE TABLE email ("
         "email_id INTEGER PRIMARY KEY,"
-        "email TEXT UNIQUE NOT NULL"
-    ");"
-)
-cur.execute(
+        "email TEXT UNIQUE NOT NULL,"
+        "friend_count INTEGER NOT NULL DEFAULT 0,"
+        "subscriber_count INTEGER NOT NULL DEFAULT 0,"
+        "blocked_by_count INTEGER NOT NULL DEFAULT 0"
+    ");",
+    # Each friendship is stored once, with the smaller email_id first
     "CREATE TABLE friend ("
         "email_id1 INTEGER NOT NULL,"
         "email_id2 INTEGER NOT NULL,"
         "FOREIGN KEY (email_id1) REFERENCES email (email_id) ON DELETE CASCADE,"
         "FOREIGN KEY (email_id2) REFERENCES email (email_id) ON DELETE CASCADE,"
-        "PRIMARY KEY (email_id1, email_id2)"
-    ");"
-)
-cur.execute(
+        "PRIMARY KEY (email_id1, email_id2),"
+        "CHECK (email_id1 < email_id2)"
+    ");",
     "CREATE TABLE subscription ("
         "subscriber_email_id INTEGER NOT NULL,"
         "target_email_id INTEGER NOT NULL,"
         "FOREIGN KEY (subscriber_email_id) REFERENCES email (email_id) ON DELETE CASCADE,"
         "FOREIGN KEY (target_email_id) REFERENCES email (email_id) ON DELETE CASCADE,"
         "PRIMARY KEY (subscriber_email_id, target_email_id)"
-    ")"
-)
-cur.execute(
+    ")",
     "CREATE TABLE block ("
         "blocker_email_id INTEGER NOT NULL,"
         "blocked_email_id INTEGER NOT NULL,"
         "FOREIGN KEY (blocker_email_id) REFERENCES email (email_id) ON DELETE CASCADE,"
         "FOREIGN KEY (blocked_email_id) REFERENCES email (email_id) ON DELETE CASCADE,"
         "PRIMARY KEY (blocker_email_id, blocked_email_id)"
-    ")"
-)
+    ")",
+    # Reverse lookups; the primary keys cover the forward direction
+    "CREATE INDEX friend_by_email_id2 ON friend (email_id2, email_id1);",
+    "CREATE INDEX subscription_by_target "
+        "ON subscription (target_email_id, subscriber_email_id);",
+    "CREATE INDEX block_by_blocked ON block (blocked_email_id, blocker_email_id);",
+    *COUNTER_TRIGGERS,
+    *CHANGE_LOG_SCHEMA,
+    *DELETION_SCHEMA,
+]
+
+# MIGRATIONS[i] upgrades a database from version i to version i + 1
+MIGRATIONS = [
+    [
+        # Rebuild friend with canonical (smaller id first) edges
+        "CREATE TABLE friend_canonical ("
+            "email_id1 INTEGER NOT NULL,"
+            "email_id2 INTEGER NOT NULL,"
+            "FOREIGN KEY (email_id1) REFERENCES email (email_id) ON DELETE CASCADE,"
+            "FOREIGN KEY (email_id2) REFERENCES email (email_id) ON DELETE CASCADE,"
+            "PRIMARY KEY (email_id1, email_id2),"
+            "CHECK (email_id1 < email_id2)"
+        ");",
+        "INSERT OR IGNORE INTO friend_canonical "
+            "SELECT MIN(email_id1, email_id2), MAX(email_id1, email_id2) "
+            "FROM friend WHERE email_id1 != email_id2;",
+        "DROP TABLE friend;",
+        "ALTER TABLE friend_canonical RENAME TO friend;",
+        "CREATE INDEX friend_by_email_id2 ON friend (email_id2, email_id1);",
+        "CREATE INDEX subscription_by_target "
+            "ON subscription (target_email_id, subscriber_email_id);",
+        "CREATE INDEX block_by_blocked ON block (blocked_email_id, blocker_email_id);",
+    ],
+    [
+        # Add and fill the degree counters
+        "ALTER TABLE email ADD COLUMN friend_count INTEGER NOT NULL DEFAULT 0;",
+        "ALTER TABLE email ADD COLUMN subscriber_count INTEGER NOT NULL DEFAULT 0;",
+        "ALTER TABLE email ADD COLUMN blocked_by_count INTEGER NOT NULL DEFAULT 0;",
+        "UPDATE email SET "
+            "friend_count = "
+                "(SELECT COUNT(*) FROM friend WHERE email_id1 = email.email_id) "
+                "+ (SELECT COUNT(*) FROM friend WHERE email_id2 = email.email_id),"
+            "subscriber_count = (SELECT COUNT(*) FROM subscription "
+                "WHERE target_email_id = email.email_id),"
+            "blocked_by_count = (SELECT COUNT(*) FROM block "
+                "WHERE blocked_email_id = email.email_id);",
+        *COUNTER_TRIGGERS,
+    ],
+    CHANGE_LOG_SCHEMA,
+    DELETION_SCHEMA,
+]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def create_schema(conn):
+    conn.execute("BEGIN IMMEDIATE;")
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+    conn.commit()
+
+
+def migrate(conn, name=DB_NAME):
+    """Upgrade an existing database in place, one version per transaction"""
+    version = get_schema_version(conn)
+    while version < SCHEMA_VERSION:
+        conn.execute("BEGIN IMMEDIATE;")
+        for statement in MIGRATIONS[version]:
+            conn.execute(statement)
+        version += 1
+        conn.execute(f"PRAGMA user_version = {version};")
+        conn.commit()
+        print(f"Migrated {name} to schema version {version}")
+
 
-conn.commit()
-conn.close()
\ No newline at end of file
+if __name__ == "__main__":
+    conn = sqlite3.connect(DB_NAME)
+    is_empty = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table';"
+    ).fetchone()[0] == 0
+    if is_empty:
+        create_schema(conn)
+    else:
+        migrate(conn)
+    conn.close()
+    # The other shards, if the database was split with `flask reshard`
+    for path in sorted(glob.glob("users.shard*.db")):
+        conn = sqlite3.connect(path)
+        migrate(conn, path)
+        conn.close()
@@ -1,295 +1,2384 @@
+import base64
+import bisect
+import collections
+import concurrent.futures
+import csv
+import heapq
+import itertools
+import json
+import os
+import queue
 import re
+import runpy
 import sqlite3
+import threading
+import time
 
-from flask import Flask, jsonify, request
+import click
+from flask import (
+    Flask, Request, Response, g, jsonify, request, stream_with_context
+)
+from flask.json.provider import DefaultJSONProvider
+
+import background_deletion
+import change_log
+import csr_snapshot
+import graph_engine
+import metrics
+import result_cache
+import sampling_profiler
+import sharding
+import write_coalescing
+
+# Optional: faster JSON, and MessagePack responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 DB_NAME = "users.db"
+# Must match SCHEMA_VERSION in db-structure.py
+SCHEMA_VERSION = 4
 EMAIL_REGEX = re.compile(r"([\w\-\.]+@[\w\-]+(?:\.[\w]+)+)")
 
 app = Flask(__name__)
+app.config.update(
+    DB_PATH=DB_NAME,
+    # Number of SQLite files users and relationships are spread across (see
+    # sharding.py); change it only with `flask reshard`
+    SHARD_COUNT=1,
+    # Number of idle connections kept open for reuse
+    DB_POOL_SIZE=8,
+    # Maximum number of email -> email_id mappings (including emails known not
+    # to exist) kept in memory
+    EMAIL_ID_CACHE_SIZE=100000,
+    # Record request and SQL statement metrics for GET /metrics
+    METRICS_ENABLED=True,
+    # Log every SQL statement taking SLOW_QUERY_SECONDS or longer (None for
+    # none) with its parameters, row count and query plan
+    SLOW_QUERY_SECONDS=None,
+    # Profile one in PROFILE_EVERY requests to each route (0 for none) with
+    # cProfile, writing each profile to a file in PROFILE_DIR
+    PROFILE_EVERY=0,
+    PROFILE_DIR="profiles",
+    # Serve /friend_list, /common_friends and /notified from an in-memory copy
+    # of the relationship tables (see graph_engine.py)
+    GRAPH_ENGINE_ENABLED=False,
+    # Load the graph engine from this snapshot file (written by `flask
+    # build-snapshot`) instead of the database, if it is still up to date
+    GRAPH_SNAPSHOT_PATH=None,
+    # Cache /friend_list, /common_friends and /notified results per user (see
+    # result_cache.py); writes made by other processes are only seen with
+    # CHANGE_LOG_SYNC_ENABLED, so without it only enable with a single server
+    # process
+    RESULT_CACHE_ENABLED=False,
+    RESULT_CACHE_MAX_BYTES=64 * 1024 * 1024,
+    # Before each request, apply the changes other processes (e.g. other
+    # gunicorn workers) have committed to this process's caches and graph
+    # engine, as recorded in change_log (see change_log.py); more than
+    # CHANGE_LOG_MAX_REPLAY changes at once drop the caches instead. The
+    # email id cache is always on, so only disable with a single server
+    # process
+    CHANGE_LOG_SYNC_ENABLED=True,
+    CHANGE_LOG_MAX_REPLAY=10000,
+    # Triggers add a change_log row for every write; every
+    # CHANGE_LOG_TRIM_EVERY write requests (0 for never), a process deletes
+    # all but the latest CHANGE_LOG_KEEP of them
+    CHANGE_LOG_KEEP=100000,
+    CHANGE_LOG_TRIM_EVERY=1000,
+    # Serve /notified from the audience table kept up to date by triggers;
+    # create it first with `flask rebuild-audience`
+    AUDIENCE_TABLE_ENABLED=False,
+    # Queue single-request writes to one writer thread, which commits the
+    # writes received within WRITE_BATCH_MAX_DELAY seconds (and at most
+    # WRITE_BATCH_MAX_SIZE of them) in one transaction
+    WRITE_COALESCING_ENABLED=False,
+    WRITE_BATCH_MAX_SIZE=256,
+    WRITE_BATCH_MAX_DELAY=0.002,
+    # /suggestions follows at most SUGGESTIONS_MAX_FANOUT friends per hop and
+    # returns what it has found after SUGGESTIONS_TIME_BUDGET seconds
+    DEFAULT_SUGGESTIONS=10,
+    SUGGESTIONS_MAX_FANOUT=1000,
+    SUGGESTIONS_TIME_BUDGET=0.05,
+    # Rows applied per transaction by the bulk endpoints
+    BULK_BATCH_SIZE=1000,
+    # Deleted users' relationship rows are removed in the background,
+    # DELETE_BATCH_SIZE per transaction, DELETE_BATCH_DELAY seconds apart
+    DELETE_BATCH_SIZE=500,
+    DELETE_BATCH_DELAY=0.01,
+    # Page sizes for endpoints taking 'limit'; /subscribers uses the default
+    # page size when no limit is given
+    DEFAULT_PAGE_SIZE=100,
+    MAX_PAGE_SIZE=10000,
+    # Run the independent reads of one request (e.g. the friend, subscriber
+    # and blocker lookups of /notified) at the same time, on connections of
+    # their own, on a pool of READ_THREADS threads
+    CONCURRENT_READS_ENABLED=False,
+    READ_THREADS=8,
+    # Threads running the app under asgi.py; requests beyond that wait,
+    # without holding a thread, until one is free
+    ASGI_MAX_THREADS=32,
+    # Applied in order to every new connection; journal_mode must stay first
+    # so that the remaining pragmas act on a WAL database
+    DB_PRAGMAS={
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -16000,
+        "mmap_size": 268435456,
+        "busy_timeout": 5000,
+        "foreign_keys": "ON",
+    },
+)
+default_pragmas = dict(app.config["DB_PRAGMAS"])
+# e.g. FLASK_DB_PATH=/data/users.db, FLASK_DB_PRAGMAS='{"synchronous": "FULL"}'
+# or FLASK_DB_PRAGMAS__synchronous=FULL
+app.config.from_prefixed_env()
+# A JSON FLASK_DB_PRAGMAS replaces the whole dict; keep the pragmas it leaves out
+app.config["DB_PRAGMAS"] = {**default_pragmas, **app.config["DB_PRAGMAS"]}
 
 
 class SqlQueries:
-    """Struct to hold SQL queries as text"""
-    # check if user A is blocked by user B
-    CHECK_IF_BLOCKING = '''SELECT * FROM block 
-        INNER JOIN email AS e1 ON block.blocker_email_id = e1.email_id
-        INNER JOIN email AS e2 ON block.blocked_email_id = e2.email_id
-        WHERE e1.email = ? AND e2.email = ?
+    """Struct to hold SQL queries as text
+
+    Apart from the email lookups, queries take email_id integers; callers
+    resolve emails once per request with get_email_id / get_email_ids.
+    Lookups and lists leave out users whose deletion is pending (see DELETE
+    /users), whose relationship rows may not have been removed yet.
+    Friend edges are stored once with the smaller email_id first (see
+    friend_edge), and every query is served by an index (see
+    `flask check-query-plans`).
+    """
+    # check if user A is blocking user B
+    CHECK_IF_BLOCKING = '''SELECT 1 FROM block
+        WHERE blocker_email_id = ? AND blocked_email_id = ?
+        ;
+    '''
+    
+    # add email to database
+    ADD_EMAIL = "INSERT INTO email (email) VALUES (?);"
+    
+    # copy a user's email row from the directory to another shard
+    ADD_EMAIL_WITH_ID = "INSERT OR IGNORE INTO email (email_id, email) VALUES (?, ?);"
+    
+    # get email_id of email, if it is in database
+    CHECK_IF_EXISTS = '''SELECT email_id FROM email WHERE email.email = ?
+        AND email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
         ;
     '''
     
-    # check if users are friends
-    CHECK_IF_FRIENDS = '''SELECT * FROM friend
-        INNER JOIN email AS e1 ON friend.email_id1 = e1.email_id
-        INNER JOIN email AS e2 ON friend.email_id2 = e2.email_id
-        WHERE (e1.email = ? AND e2.email = ?)
-        OR (e2.email = ? AND e1.email = ?)
+    # get (email, email_id) of those emails in a JSON array which are in database
+    GET_EMAIL_IDS = '''SELECT email, email_id FROM email
+        WHERE email IN (SELECT value FROM json_each(?))
+        AND email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
         ;
     '''
     
-    # check if user A is subscribed to user B
-    CHECK_IF_SUBSCRIBED = '''SELECT * FROM subscription 
-        INNER JOIN email AS e1 ON subscription.subscriber_email_id = e1.email_id
-        INNER JOIN email AS e2 ON subscription.target_email_id = e2.email_id
-        WHERE e1.email = ? AND e2.email = ?
+    # get email_id, email for email_ids in a JSON array
+    GET_EMAILS = '''SELECT email_id, email FROM email
+        WHERE email_id IN (SELECT value FROM json_each(?))
+        AND email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
         ;
     '''
     
-    # add email to database
-    ADD_EMAIL = "INSERT INTO email (email) VALUES (?);"
+    # get those (email_id1, email_id2) pairs in a JSON array of pairs which are
+    # friends; pairs must be in friend_edge order
+    FIND_FRIENDS = '''SELECT email_id1, email_id2 FROM friend
+        WHERE (email_id1, email_id2) IN (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]')
+            FROM json_each(?)
+        );
+    '''
     
-    # check if email in database
-    CHECK_IF_EXISTS = "SELECT * FROM email WHERE email.email = ?;"
+    # get those (subscriber, target) pairs in a JSON array of pairs which exist
+    FIND_SUBSCRIPTIONS = '''SELECT subscriber_email_id, target_email_id
+        FROM subscription
+        WHERE (subscriber_email_id, target_email_id) IN (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]')
+            FROM json_each(?)
+        );
+    '''
+    
+    # get those (blocker, blocked) pairs in a JSON array of pairs which exist
+    FIND_BLOCKS = '''SELECT blocker_email_id, blocked_email_id FROM block
+        WHERE (blocker_email_id, blocked_email_id) IN (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]')
+            FROM json_each(?)
+        );
+    '''
     
     # establish friend connection
     ESTABLISH_FRIEND_CONNECTION = '''INSERT INTO friend (email_id1, email_id2)
-        SELECT e1.email_id, e2.email_id
-        FROM email AS e1
-        INNER JOIN email AS e2
-        ON e1.email = ? AND e2.email = ?
+        VALUES (?, ?)
         ;
     '''
     
     # delete friend connection
     UNFRIEND = '''DELETE FROM friend
-        WHERE (email_id1, email_id2) IN (
-            SELECT email_id1, email_id2 FROM friend
-            INNER JOIN email AS e1 ON friend.email_id1 = e1.email_id
-            INNER JOIN email AS e2 ON friend.email_id2 = e2.email_id
-            WHERE (e1.email = ? AND e2.email = ?) OR (e2.email = ? AND e1.email = ?)
-        );
+        WHERE email_id1 = ? AND email_id2 = ?
+        ;
     '''
     
     # get friend list of user
-    GET_FRIEND_LIST = '''SELECT e2.email FROM friend
-        INNER JOIN email AS e1 ON friend.email_id1 = e1.email_id
-        INNER JOIN email AS e2 ON friend.email_id2 = e2.email_id
-        WHERE e1.email = ?
-        UNION
-        SELECT e1.email FROM friend
-        INNER JOIN email AS e1 ON friend.email_id1 = e1.email_id
-        INNER JOIN email AS e2 ON friend.email_id2 = e2.email_id
-        WHERE e2.email = ?
+    GET_FRIEND_LIST = '''SELECT email.email FROM friend
+        INNER JOIN email ON friend.email_id2 = email.email_id
+        WHERE friend.email_id1 = ? AND friend.email_id2 NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        UNION ALL
+        SELECT email.email FROM friend
+        INNER JOIN email ON friend.email_id1 = email.email_id
+        WHERE friend.email_id2 = ? AND friend.email_id1 NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        ;
+    '''
+    
+    # get (email_id, email) of friends of user with email_id above a cursor, in
+    # email_id order; parameters are email_id, cursor, email_id, cursor, limit
+    GET_FRIEND_PAGE = '''SELECT friend_id, email.email FROM (
+            SELECT email_id2 AS friend_id FROM friend
+            WHERE email_id1 = ? AND email_id2 > ?
+            AND email_id2 NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+            UNION ALL
+            SELECT email_id1 FROM friend
+            WHERE email_id2 = ? AND email_id1 > ?
+            AND email_id1 NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+            ORDER BY 1
+            LIMIT ?
+        )
+        INNER JOIN email ON email.email_id = friend_id
+        ORDER BY friend_id
+        ;
+    '''
+    
+    # get email_ids of up to LIMIT friends of user (-1 for all); parameters
+    # are email_id x2, limit
+    GET_FRIEND_IDS = '''SELECT email_id2 FROM friend WHERE email_id1 = ?
+        AND email_id2 NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        UNION ALL
+        SELECT email_id1 FROM friend WHERE email_id2 = ?
+        AND email_id1 NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        LIMIT ?
+        ;
+    '''
+    
+    # degree counters, kept up to date by triggers
+    GET_FRIEND_COUNT = '''SELECT friend_count FROM email WHERE email_id = ?
+        ;
+    '''
+    
+    GET_SUBSCRIBER_COUNT = '''SELECT subscriber_count FROM email
+        WHERE email_id = ?
         ;
     '''
     
+    # get counters of emails in a JSON array
+    GET_USER_STATS = '''SELECT email, friend_count, subscriber_count,
+        blocked_by_count FROM email
+        WHERE email IN (SELECT value FROM json_each(?))
+        AND email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        ;
+    '''
+    
+    # get friends of user which are also friends of every user in a JSON array
+    # of email_ids; parameters are email_id x2, other email_ids. Each friend of
+    # the first user costs one primary key lookup per other user, so the first
+    # user should be the one with the fewest friends
+    GET_COMMON_FRIENDS = '''SELECT email.email FROM (
+            SELECT email_id2 AS friend_id FROM friend WHERE email_id1 = ?
+            UNION ALL
+            SELECT email_id1 FROM friend WHERE email_id2 = ?
+        ) AS f
+        INNER JOIN email ON email.email_id = f.friend_id
+        WHERE f.friend_id NOT IN (SELECT email_id FROM deletion
+            WHERE finished_at IS NULL
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM json_each(?) AS other
+            WHERE NOT EXISTS (
+                SELECT 1 FROM friend
+                WHERE email_id1 = MIN(f.friend_id, other.value)
+                AND email_id2 = MAX(f.friend_id, other.value)
+            )
+        );
+    '''
+    
+    # as GET_COMMON_FRIENDS, but only count them
+    COUNT_COMMON_FRIENDS = '''SELECT COUNT(*) FROM (
+            SELECT email_id2 AS friend_id FROM friend WHERE email_id1 = ?
+            UNION ALL
+            SELECT email_id1 FROM friend WHERE email_id2 = ?
+        ) AS f
+        WHERE f.friend_id NOT IN (SELECT email_id FROM deletion
+            WHERE finished_at IS NULL
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM json_each(?) AS other
+            WHERE NOT EXISTS (
+                SELECT 1 FROM friend
+                WHERE email_id1 = MIN(f.friend_id, other.value)
+                AND email_id2 = MAX(f.friend_id, other.value)
+            )
+        );
+    '''
+    
     # get subscriber list of user
-    GET_SUBSCRIBER_LIST = '''SELECT e1.email FROM subscription
-        INNER JOIN email AS e1 ON subscription.subscriber_email_id = e1.email_id
-        INNER JOIN email AS e2 ON subscription.target_email_id = e2.email_id
-        WHERE e2.email = ?
+    GET_SUBSCRIBER_LIST = '''SELECT email.email FROM subscription
+        INNER JOIN email ON subscription.subscriber_email_id = email.email_id
+        WHERE subscription.target_email_id = ?
+        AND subscription.subscriber_email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        ;
+    '''
+    
+    # get (email_id, email) of subscribers of user with email_id above a
+    # cursor, in email_id order; parameters are email_id, cursor, limit
+    GET_SUBSCRIBER_PAGE = '''SELECT email.email_id, email.email FROM subscription
+        INNER JOIN email ON subscription.subscriber_email_id = email.email_id
+        WHERE subscription.target_email_id = ?
+        AND subscription.subscriber_email_id > ?
+        AND subscription.subscriber_email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        ORDER BY subscription.subscriber_email_id
+        LIMIT ?
         ;
     '''
     
     # get list of users who block provided user
-    GET_BLOCKER_LIST = '''SELECT e1.email FROM block
-        INNER JOIN email AS e1 ON block.blocker_email_id = e1.email_id
-        INNER JOIN email AS e2 ON block.blocked_email_id = e2.email_id
-        WHERE e2.email = ?
+    GET_BLOCKER_LIST = '''SELECT email.email FROM block
+        INNER JOIN email ON block.blocker_email_id = email.email_id
+        WHERE block.blocked_email_id = ?
+        ;
+    '''
+    
+    # get users notified of an update by a sender: friends, subscribers and
+    # mentioned emails (as a JSON array), less users who block the sender;
+    # parameters are sender_id x3, mentions, sender_id
+    GET_RECIPIENTS = '''SELECT email.email FROM email
+        WHERE email.email_id IN (
+            SELECT email_id2 FROM friend WHERE email_id1 = ?
+            UNION ALL
+            SELECT email_id1 FROM friend WHERE email_id2 = ?
+            UNION ALL
+            SELECT subscriber_email_id FROM subscription WHERE target_email_id = ?
+        )
+        AND email.email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        UNION
+        SELECT email.email FROM email
+        WHERE email.email IN (SELECT value FROM json_each(?))
+        AND email.email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        EXCEPT
+        SELECT email.email FROM block
+        INNER JOIN email ON block.blocker_email_id = email.email_id
+        WHERE block.blocked_email_id = ?
+        ;
+    '''
+    
+    # as GET_RECIPIENTS, as email_ids, taking the email_ids of the mentioned
+    # users; parameters are sender_id x3, mention ids, sender_id
+    GET_RECIPIENT_IDS = '''SELECT email_id2 FROM friend WHERE email_id1 = ?
+        UNION
+        SELECT email_id1 FROM friend WHERE email_id2 = ?
+        UNION
+        SELECT subscriber_email_id FROM subscription WHERE target_email_id = ?
+        UNION
+        SELECT value FROM json_each(?)
+        EXCEPT
+        SELECT blocker_email_id FROM block WHERE blocked_email_id = ?
+        EXCEPT
+        SELECT email_id FROM deletion WHERE finished_at IS NULL
+        ;
+    '''
+    
+    # as GET_RECIPIENTS, from the audience table (see AUDIENCE_SCHEMA);
+    # parameters are sender_id, mentions, sender_id
+    GET_RECIPIENTS_FROM_AUDIENCE = '''SELECT email.email FROM audience
+        INNER JOIN email ON audience.recipient_email_id = email.email_id
+        WHERE audience.sender_email_id = ?
+        AND audience.recipient_email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        UNION
+        SELECT email.email FROM email
+        WHERE email.email IN (SELECT value FROM json_each(?))
+        AND email.email_id NOT IN (SELECT email_id FROM deletion WHERE finished_at IS NULL)
+        AND NOT EXISTS (SELECT 1 FROM block
+            WHERE block.blocker_email_id = email.email_id
+            AND block.blocked_email_id = ?
+        )
+        ;
+    '''
+    
+    # as GET_RECIPIENT_IDS, from the audience table; parameters are sender_id,
+    # mention ids, sender_id
+    GET_RECIPIENT_IDS_FROM_AUDIENCE = '''SELECT recipient_email_id FROM audience
+        WHERE sender_email_id = ?
+        UNION
+        SELECT value FROM json_each(?)
+        WHERE NOT EXISTS (SELECT 1 FROM block
+            WHERE block.blocker_email_id = value AND block.blocked_email_id = ?
+        )
+        EXCEPT
+        SELECT email_id FROM deletion WHERE finished_at IS NULL
         ;
     '''
     
     # subscribe user to target; subscriber is first, target is second
     SUBSCRIBE_USER_TO_TARGET = '''INSERT INTO subscription
-        SELECT e1.email_id, e2.email_id
-        FROM email AS e1
-        INNER JOIN email AS e2
-        ON e1.email = ? AND e2.email = ?
+        (subscriber_email_id, target_email_id) VALUES (?, ?)
+        ;
     '''
     
     # unsubscribe user from target; subscriber is first, target is second
     UNSUBSCRIBE_USER_FROM_TARGET = '''DELETE FROM subscription
-        WHERE (subscriber_email_id, target_email_id) IN (
-            SELECT subscriber_email_id, target_email_id FROM subscription
-            INNER JOIN email AS e1 ON subscription.subscriber_email_id = e1.email_id
-            INNER JOIN email AS e2 ON subscription.target_email_id = e2.email_id
-            WHERE e1.email = ? AND e2.email = ?
-        );
+        WHERE subscriber_email_id = ? AND target_email_id = ?
+        ;
     '''
     
     # block target; requestor is first, target is second
     BLOCK_USER_TARGET = '''INSERT INTO block
-        SELECT e1.email_id, e2.email_id
-        FROM email AS e1
-        INNER JOIN email AS e2
-        ON e1.email = ? AND e2.email = ?
+        (blocker_email_id, blocked_email_id) VALUES (?, ?)
+        ;
     '''
     
     # unblock target; requestor is first, target is second
     UNBLOCK_USER_TARGET = '''DELETE FROM block
-        WHERE (blocker_email_id, blocked_email_id) IN (
-            SELECT blocker_email_id, blocked_email_id FROM block
-            INNER JOIN email AS e1 ON block.blocker_email_id = e1.email_id
-            INNER JOIN email AS e2 ON block.blocked_email_id = e2.email_id
-            WHERE e1.email = ? AND e2.email = ?
-        );
+        WHERE blocker_email_id = ? AND blocked_email_id = ?
+        ;
+    '''
+    
+    # User deletion: DELETE /users adds the user to deletion on every shard,
+    # after which the queries above leave them out, and the background deleter
+    # removes their relationship rows in batches, then their email rows.
+    
+    # mark user deleted; parameters are email_id, email, requested_at
+    ADD_DELETION = '''INSERT OR REPLACE INTO deletion (email_id, email, requested_at)
+        VALUES (?, ?, ?)
+        ;
+    '''
+    
+    # get email_ids of users whose deletion is pending
+    GET_PENDING_DELETIONS = '''SELECT email_id FROM deletion
+        WHERE finished_at IS NULL
+        ORDER BY email_id
+        ;
+    '''
+    
+    # get (email_id, requested_at, finished_at) of the latest deletion of email
+    GET_DELETION = '''SELECT email_id, requested_at, finished_at FROM deletion
+        WHERE email = ?
+        ORDER BY requested_at DESC
+        LIMIT 1
+        ;
+    '''
+    
+    # get number of relationship rows of a deleted user removed from a shard
+    GET_REMOVED_ROWS = "SELECT removed_rows FROM deletion WHERE email_id = ?;"
+    
+    # count relationship rows of a user either way; parameters are email_id x6
+    COUNT_USER_ROWS = '''SELECT
+        (SELECT COUNT(*) FROM friend WHERE email_id1 = ?)
+        + (SELECT COUNT(*) FROM friend WHERE email_id2 = ?)
+        + (SELECT COUNT(*) FROM subscription WHERE subscriber_email_id = ?)
+        + (SELECT COUNT(*) FROM subscription WHERE target_email_id = ?)
+        + (SELECT COUNT(*) FROM block WHERE blocker_email_id = ?)
+        + (SELECT COUNT(*) FROM block WHERE blocked_email_id = ?)
+        ;
+    '''
+    
+    # delete up to LIMIT rows of a user from a relationship table, returning
+    # them; parameters are email_id x2, limit
+    DELETE_USER_FRIENDS = '''DELETE FROM friend WHERE rowid IN (
+            SELECT rowid FROM friend WHERE email_id1 = ?
+            UNION ALL
+            SELECT rowid FROM friend WHERE email_id2 = ?
+            LIMIT ?
+        )
+        RETURNING email_id1, email_id2
+        ;
+    '''
+    
+    DELETE_USER_SUBSCRIPTIONS = '''DELETE FROM subscription WHERE rowid IN (
+            SELECT rowid FROM subscription WHERE subscriber_email_id = ?
+            UNION ALL
+            SELECT rowid FROM subscription WHERE target_email_id = ?
+            LIMIT ?
+        )
+        RETURNING subscriber_email_id, target_email_id
+        ;
+    '''
+    
+    DELETE_USER_BLOCKS = '''DELETE FROM block WHERE rowid IN (
+            SELECT rowid FROM block WHERE blocker_email_id = ?
+            UNION ALL
+            SELECT rowid FROM block WHERE blocked_email_id = ?
+            LIMIT ?
+        )
+        RETURNING blocker_email_id, blocked_email_id
+        ;
+    '''
+    
+    # count rows removed by the background deleter; parameters are row count,
+    # email_id
+    ADD_REMOVED_ROWS = '''UPDATE deletion SET removed_rows = removed_rows + ?
+        WHERE email_id = ?
+        ;
+    '''
+    
+    # delete a user's email row, once their relationship rows are gone
+    DELETE_EMAIL = "DELETE FROM email WHERE email_id = ?;"
+    
+    # parameters are finished_at, email_id
+    FINISH_DELETION = "UPDATE deletion SET finished_at = ? WHERE email_id = ?;"
+    
+    # Conditional writes: each inserts its row only if the endpoint's checks
+    # pass, in one statement. When nothing is inserted, the matching DIAGNOSE_
+    # query tells which check failed, in the order the errors are reported.
+    
+    # befriend users (friend_edge order) unless either blocks the other or
+    # they are friends; parameters are email_id1, email_id2 x3
+    ADD_FRIEND_IF_ALLOWED = '''INSERT INTO friend (email_id1, email_id2)
+        SELECT ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM block
+            WHERE blocker_email_id = ? AND blocked_email_id = ?
+        )
+        AND NOT EXISTS (SELECT 1 FROM block
+            WHERE blocker_email_id = ? AND blocked_email_id = ?
+        )
+        ON CONFLICT DO NOTHING
+        ;
+    '''
+    
+    # (are users friends, is either user blocking the other); parameters as
+    # for ADD_FRIEND_IF_ALLOWED
+    DIAGNOSE_FRIEND = '''SELECT
+        EXISTS (SELECT 1 FROM friend WHERE email_id1 = ? AND email_id2 = ?),
+        EXISTS (SELECT 1 FROM block
+            WHERE blocker_email_id = ? AND blocked_email_id = ?
+        )
+        OR EXISTS (SELECT 1 FROM block
+            WHERE blocker_email_id = ? AND blocked_email_id = ?
+        )
+        ;
+    '''
+    
+    # subscribe requestor to target unless requestor blocks target or is
+    # subscribed already; parameters are requestor_id, target_id x2
+    SUBSCRIBE_IF_ALLOWED = '''INSERT INTO subscription
+        (subscriber_email_id, target_email_id)
+        SELECT ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM block
+            WHERE blocker_email_id = ? AND blocked_email_id = ?
+        )
+        ON CONFLICT DO NOTHING
+        ;
+    '''
+    
+    # (is requestor blocking target, is requestor subscribed); parameters are
+    # requestor_id, target_id x2
+    DIAGNOSE_SUBSCRIBE = '''SELECT
+        EXISTS (SELECT 1 FROM block
+            WHERE blocker_email_id = ? AND blocked_email_id = ?
+        ),
+        EXISTS (SELECT 1 FROM subscription
+            WHERE subscriber_email_id = ? AND target_email_id = ?
+        )
+        ;
+    '''
+    
+    # block target by requestor unless they are friends, requestor is
+    # subscribed to target or blocks it already; parameters are requestor_id,
+    # target_id, email_id1, email_id2 (friend_edge order), requestor_id,
+    # target_id
+    BLOCK_IF_ALLOWED = '''INSERT INTO block (blocker_email_id, blocked_email_id)
+        SELECT ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM friend
+            WHERE email_id1 = ? AND email_id2 = ?
+        )
+        AND NOT EXISTS (SELECT 1 FROM subscription
+            WHERE subscriber_email_id = ? AND target_email_id = ?
+        )
+        ON CONFLICT DO NOTHING
+        ;
+    '''
+    
+    # (is requestor blocking target, are users friends, is requestor
+    # subscribed); parameters as for BLOCK_IF_ALLOWED
+    DIAGNOSE_BLOCK = '''SELECT
+        EXISTS (SELECT 1 FROM block
+            WHERE blocker_email_id = ? AND blocked_email_id = ?
+        ),
+        EXISTS (SELECT 1 FROM friend WHERE email_id1 = ? AND email_id2 = ?),
+        EXISTS (SELECT 1 FROM subscription
+            WHERE subscriber_email_id = ? AND target_email_id = ?
+        )
+        ;
+    '''
+    
+    # Keep the latest ? changes
+    TRIM_CHANGE_LOG = '''DELETE FROM change_log
+        WHERE change_id <= (SELECT MAX(change_id) FROM change_log) - ?
+        ;
     '''
 
 
-def connect_to_db(db_path=DB_NAME):
-    con = sqlite3.connect(db_path)
-    return con
+class ErrorMessages:
+    """Struct to hold error messages returned in JSON responses"""
+    NO_JSON = "No JSON received"
+    INVALID_EMAIL = "Invalid email address received"
+    NO_EMAIL = "No email address received (JSON key should be 'email')"
+    NO_EMAILS = ("No email addresses received (JSON key should be 'email', or "
+        "'emails' for an array of email addresses)")
+    NO_FRIENDS = ("No email addresses received (JSON key should be 'friends', "
+        "email addresses should be in array value)")
+    NO_REQUESTOR_TARGET = ("No email addresses received (JSON keys should be "
+        "'requestor'and 'target' for respective email addresses)")
+    TWO_EMAILS_REQUIRED = "Two distinct valid email addresses required"
+    EMAIL_EXISTS = "Email already exists"
+    EMAIL_NOT_FOUND = "Email does not exist"
+    EMAILS_NOT_FOUND = "One or both of the provided emails does not exist."
+    USERS_BLOCKING = "At least one user is blocking the other"
+    ALREADY_FRIENDS = "Users are already friends"
+    REQUESTOR_BLOCKING = "Requestor has blocked target, please unblock first"
+    ALREADY_SUBSCRIBED = "User already subscribed"
+    USERS_FRIENDS = "Users are friends (unfriend the target first)"
+    REQUESTOR_SUBSCRIBED = ("Requestor is subscribed to target (unsubscribe from "
+        "target first)")
+    ALREADY_BLOCKED = "User already blocked target"
+    NO_SENDER_TEXT = ("JSON keys should be 'sender' for sender email and 'text' "
+        "for message text")
+    SENDER_NOT_FOUND = "Sender email does not exist"
+    NO_MESSAGES = ("Request body should be a JSON array of objects with keys "
+        "'sender' and 'text'")
+    INVALID_LIMIT = "'limit' should be a positive integer no larger than {}"
+    INVALID_CURSOR = "Invalid 'after' cursor"
+    NO_DELETION = "No deletion was requested for this email"
+    NO_RESOLVE_KEYS = ("JSON keys should be 'emails' for an array of email "
+        "addresses, or 'email_ids' for an array of integer email ids"
+    )
+    INTEGRITY_ERROR = "Unexpected SQLite integrity error"
 
 
-def create_json_response(is_success=False, **kwargs):
-    return jsonify({"success": is_success, **kwargs})
+# Optional table holding the recipients of each sender's updates before
+# mentions (friends and subscribers, less users blocking the sender), kept up
+# to date by triggers on the relationship tables. Created, filled and dropped
+# by `flask rebuild-audience`, as it is not part of the schema version.
+AUDIENCE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS audience ("
+        "sender_email_id INTEGER NOT NULL,"
+        "recipient_email_id INTEGER NOT NULL,"
+        "FOREIGN KEY (sender_email_id) REFERENCES email (email_id) ON DELETE CASCADE,"
+        "FOREIGN KEY (recipient_email_id) REFERENCES email (email_id) ON DELETE CASCADE,"
+        "PRIMARY KEY (sender_email_id, recipient_email_id)"
+    ") WITHOUT ROWID;",
+    # Serves the foreign key on recipient_email_id, which is checked when users
+    # are added or removed
+    "CREATE INDEX IF NOT EXISTS audience_by_recipient "
+        "ON audience (recipient_email_id, sender_email_id);",
+    '''CREATE TRIGGER IF NOT EXISTS audience_friend_insert AFTER INSERT ON friend
+    BEGIN
+        INSERT OR IGNORE INTO audience SELECT NEW.email_id1, NEW.email_id2
+            WHERE NOT EXISTS (SELECT 1 FROM block
+                WHERE blocker_email_id = NEW.email_id2
+                AND blocked_email_id = NEW.email_id1
+            );
+        INSERT OR IGNORE INTO audience SELECT NEW.email_id2, NEW.email_id1
+            WHERE NOT EXISTS (SELECT 1 FROM block
+                WHERE blocker_email_id = NEW.email_id1
+                AND blocked_email_id = NEW.email_id2
+            );
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS audience_friend_delete AFTER DELETE ON friend
+    BEGIN
+        DELETE FROM audience
+            WHERE sender_email_id = OLD.email_id1
+            AND recipient_email_id = OLD.email_id2
+            AND NOT EXISTS (SELECT 1 FROM subscription
+                WHERE subscriber_email_id = OLD.email_id2
+                AND target_email_id = OLD.email_id1
+            );
+        DELETE FROM audience
+            WHERE sender_email_id = OLD.email_id2
+            AND recipient_email_id = OLD.email_id1
+            AND NOT EXISTS (SELECT 1 FROM subscription
+                WHERE subscriber_email_id = OLD.email_id1
+                AND target_email_id = OLD.email_id2
+            );
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS audience_subscription_insert
+    AFTER INSERT ON subscription
+    BEGIN
+        INSERT OR IGNORE INTO audience
+            SELECT NEW.target_email_id, NEW.subscriber_email_id
+            WHERE NOT EXISTS (SELECT 1 FROM block
+                WHERE blocker_email_id = NEW.subscriber_email_id
+                AND blocked_email_id = NEW.target_email_id
+            );
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS audience_subscription_delete
+    AFTER DELETE ON subscription
+    BEGIN
+        DELETE FROM audience
+            WHERE sender_email_id = OLD.target_email_id
+            AND recipient_email_id = OLD.subscriber_email_id
+            AND NOT EXISTS (SELECT 1 FROM friend
+                WHERE email_id1 = MIN(OLD.target_email_id, OLD.subscriber_email_id)
+                AND email_id2 = MAX(OLD.target_email_id, OLD.subscriber_email_id)
+            );
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS audience_block_insert AFTER INSERT ON block
+    BEGIN
+        DELETE FROM audience
+            WHERE sender_email_id = NEW.blocked_email_id
+            AND recipient_email_id = NEW.blocker_email_id;
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS audience_block_delete AFTER DELETE ON block
+    BEGIN
+        INSERT OR IGNORE INTO audience
+            SELECT OLD.blocked_email_id, OLD.blocker_email_id
+            WHERE EXISTS (SELECT 1 FROM friend
+                WHERE email_id1 = MIN(OLD.blocked_email_id, OLD.blocker_email_id)
+                AND email_id2 = MAX(OLD.blocked_email_id, OLD.blocker_email_id)
+            )
+            OR EXISTS (SELECT 1 FROM subscription
+                WHERE subscriber_email_id = OLD.blocker_email_id
+                AND target_email_id = OLD.blocked_email_id
+            );
+    END;''',
+]
 
+DROP_AUDIENCE = [
+    "DROP TRIGGER IF EXISTS audience_friend_insert;",
+    "DROP TRIGGER IF EXISTS audience_friend_delete;",
+    "DROP TRIGGER IF EXISTS audience_subscription_insert;",
+    "DROP TRIGGER IF EXISTS audience_subscription_delete;",
+    "DROP TRIGGER IF EXISTS audience_block_insert;",
+    "DROP TRIGGER IF EXISTS audience_block_delete;",
+    "DROP TABLE IF EXISTS audience;",
+]
 
-def respond_success():
-    return create_json_response(is_success=True)
+# (sender_email_id, recipient_email_id) rows the audience table should hold,
+# computed from the relationship tables
+LIVE_AUDIENCE = '''SELECT sender, recipient FROM (
+        SELECT email_id1 AS sender, email_id2 AS recipient FROM friend
+        UNION
+        SELECT email_id2, email_id1 FROM friend
+        UNION
+        SELECT target_email_id, subscriber_email_id FROM subscription
+    )
+    WHERE NOT EXISTS (SELECT 1 FROM block
+        WHERE blocker_email_id = recipient AND blocked_email_id = sender
+    )
+'''
 
 
-def respond_no_json_received():
-    return create_json_response(is_success=False, error="No JSON received")
+registry = metrics.Registry()
+REQUESTS = registry.counter("http_requests_total",
+    "HTTP requests handled", ("method", "route", "status")
+)
+REQUEST_SECONDS = registry.histogram("http_request_duration_seconds",
+    "Time to handle HTTP requests, including streaming the response",
+    ("method", "route")
+)
+REQUEST_PHASE_SECONDS = registry.histogram("http_request_phase_duration_seconds",
+    "Time spent parsing JSON, scanning text for emails and serializing JSON",
+    ("route", "phase")
+)
+SQL_STATEMENTS = registry.counter("sql_statements_total",
+    "SQL statements executed, by SqlQueries name", ("statement",)
+)
+SQL_SECONDS = registry.histogram("sql_statement_duration_seconds",
+    "Time executing SQL statements and fetching their rows", ("statement",)
+)
+SQL_ROWS = registry.counter("sql_rows_returned_total",
+    "Rows fetched from SQL statements", ("statement",)
+)
 
+# Statements not in SqlQueries (pragmas, transaction control, ...) are "other"
+_STATEMENT_NAMES = {
+    query: name for name, query in vars(SqlQueries).items() if name.isupper()
+}
 
-def respond_invalid_email_received():
-    return create_json_response(is_success=False,
-        error="Invalid email address received"
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor recording each statement's count, rows and time taken from
+    execution until its rows are exhausted or the cursor is closed, and
+    logging statements slower than SLOW_QUERY_SECONDS
+    """
+    _statement = None
+    
+    def _start(self, sql, parameters):
+        self._finish()
+        self._statement = _STATEMENT_NAMES.get(sql, "other")
+        self._sql = sql
+        self._parameters = parameters
+        self._elapsed = 0.0
+        self._rows = 0
+        if app.config["METRICS_ENABLED"]:
+            SQL_STATEMENTS.inc(self._statement)
+    
+    def _finish(self):
+        if self._statement is None:
+            return
+        if app.config["METRICS_ENABLED"]:
+            SQL_SECONDS.observe(self._elapsed, self._statement)
+            SQL_ROWS.inc(self._statement, amount=self._rows)
+        threshold = app.config["SLOW_QUERY_SECONDS"]
+        if threshold is not None and self._elapsed >= threshold:
+            log_slow_query(self.connection, self._statement, self._sql,
+                self._parameters, self._rows, self._elapsed
+            )
+        self._statement = None
+    
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._elapsed += time.perf_counter() - started
+            # Statements without result rows are complete once executed
+            if self.description is None:
+                self._finish()
+    
+    def executemany(self, sql, seq_of_parameters):
+        # Parameters may be an iterator, which only the statement can consume
+        self._start(sql, None)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._elapsed += time.perf_counter() - started
+            self._finish()
+    
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._elapsed += time.perf_counter() - started
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+    
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+    
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        self._finish()
+        return rows
+    
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._elapsed += time.perf_counter() - started
+            self._finish()
+            raise
+        self._elapsed += time.perf_counter() - started
+        self._rows += 1
+        return row
+    
+    def close(self):
+        self._finish()
+        super().close()
+
+
+# Longest repr of a slow query's parameters logged, e.g. of a JSON array
+SLOW_QUERY_MAX_PARAMETERS = 1000
+
+
+def log_slow_query(conn, statement, sql, parameters, rows, elapsed):
+    """Log a slow statement run on conn, with its query plan"""
+    if parameters is None:
+        # Any value will do for the plan, as in `flask check-query-plans`
+        plan_parameters = ("[]",) * sql.count("?")
+    else:
+        plan_parameters = parameters
+    # A plain cursor, so that the plan is neither counted nor logged itself
+    cur = sqlite3.Cursor(conn)
+    try:
+        cur.execute("EXPLAIN QUERY PLAN " + sql, plan_parameters)
+        plan = "\n".join(f"    {row[-1]}" for row in cur.fetchall()) or "    none"
+    except sqlite3.Error as err:
+        plan = f"    unavailable ({err})"
+    finally:
+        cur.close()
+    parameters = "(executemany)" if parameters is None else repr(parameters)
+    if len(parameters) > SLOW_QUERY_MAX_PARAMETERS:
+        parameters = parameters[:SLOW_QUERY_MAX_PARAMETERS] + "..."
+    app.logger.warning("Slow query %s: %.1f ms, %d rows, parameters %s, plan:\n%s",
+        statement if statement != "other" else " ".join(sql.split()),
+        elapsed * 1000, rows, parameters, plan
     )
 
 
-def is_email_valid(email_str):
-    """Validate email address. Currently only checks against a simple regex.
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+class InstrumentedRequest(Request):
+    def get_json(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().get_json(*args, **kwargs)
+        finally:
+            observe_phase("parse_json", started)
+
+
+app.request_class = InstrumentedRequest
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider encoding and parsing with orjson, several times faster
+    than the json module, into the same JSON documents
     """
-    match = EMAIL_REGEX.fullmatch(email_str)
-    return match is not None
+    def _option(self):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+    
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._option()).decode()
+    
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Indented output, as in debug mode, is left to the json module
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default,
+            option=self._option() | orjson.OPT_APPEND_NEWLINE
+        ), mimetype=self.mimetype)
 
 
-def does_email_exist(conn, email):
-    cur = conn.cursor()
-    cur.execute(SqlQueries.CHECK_IF_EXISTS, (email,))
-    res = cur.fetchone() is not None
-    cur.close()
-    return res
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 
+# Accepted MessagePack media types, the first being the default
+MSGPACK_MIMETYPES = [
+    "application/msgpack", "application/vnd.msgpack", "application/x-msgpack"
+]
 
-def are_users_friends(conn, email1, email2):
-    cur = conn.cursor()
-    cur.execute(SqlQueries.CHECK_IF_FRIENDS, (email1, email2, email1, email2))
-    res = cur.fetchone() is not None
-    cur.close()
-    return res
 
+def observe_phase(phase, started):
+    if app.config["METRICS_ENABLED"]:
+        REQUEST_PHASE_SECONDS.observe(time.perf_counter() - started,
+            g.get("route", "none"), phase
+        )
 
-def are_users_blocking(conn, blocker, blocked):
-    cur = conn.cursor()
-    cur.execute(SqlQueries.CHECK_IF_BLOCKING, (blocker, blocked))
-    res = cur.fetchone() is not None
-    cur.close()
-    return res
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Looked up once, as every access to request goes through a context local
+    g.route = request.url_rule.rule if request.url_rule is not None else "unmatched"
 
-def is_user_subscribed(conn, user, target):
-    cur = conn.cursor()
-    cur.execute(SqlQueries.CHECK_IF_SUBSCRIBED, (user, target))
-    res = cur.fetchone() is not None
-    cur.close()
-    return res
 
+@app.after_request
+def count_request(response):
+    if app.config["METRICS_ENABLED"]:
+        REQUESTS.inc(request.method, g.route, str(response.status_code))
+    return response
 
-def get_friend_list(conn, email):
-    cur = conn.cursor()
-    cur.execute(SqlQueries.GET_FRIEND_LIST, (email, email))
-    friend_list = [item[0] for item in cur.fetchall()]
-    cur.close()
-    return friend_list
 
+@app.teardown_request
+def observe_request_duration(exc):
+    started = g.pop("request_started", None)
+    if started is not None and app.config["METRICS_ENABLED"]:
+        REQUEST_SECONDS.observe(time.perf_counter() - started,
+            request.method, g.route
+        )
 
-def get_subscriber_list(conn, email):
-    cur = conn.cursor()
-    cur.execute(SqlQueries.GET_SUBSCRIBER_LIST, (email,))
-    subscriber_list = [item[0] for item in cur.fetchall()]
-    cur.close()
-    return subscriber_list
 
+_profiler = None
+_profiler_lock = threading.Lock()
 
-def get_blocker_list(conn, email):
-    cur = conn.cursor()
-    cur.execute(SqlQueries.GET_BLOCKER_LIST, (email,))
-    blocker_list = [item[0] for item in cur.fetchall()]
-    cur.close()
-    return blocker_list
+
+def get_profiler():
+    global _profiler
+    if _profiler is None:
+        with _profiler_lock:
+            if _profiler is None:
+                _profiler = sampling_profiler.SamplingProfiler(
+                    app.config["PROFILE_EVERY"], app.config["PROFILE_DIR"]
+                )
+    return _profiler
 
 
-@app.post("/users")
-def add_email():
-    req = request.get_json()
-    if req is None:
-        return respond_no_json_received()
-    try:
-        email = req["email"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="No email address received (JSON key should be 'email')"
+registry.gauge_collector("request_profiler",
+    "Request profiler counters, by statistic", "stat",
+    lambda: get_profiler().stats()
+)
+
+
+@app.before_request
+def start_profile():
+    if app.config["PROFILE_EVERY"]:
+        g.profile = get_profiler().start(request.method, g.route)
+
+
+@app.teardown_request
+def stop_profile(exc):
+    # Streamed bodies are generated after this, and are not profiled
+    profile = g.pop("profile", None)
+    if profile is not None:
+        get_profiler().stop(profile, request.method, g.route)
+
+
+class ConnectionPool:
+    """Pool of long-lived SQLite connections to a single database file.
+
+    Connections are opened lazily, configured once with the given pragmas and
+    handed back to the pool after each request instead of being closed.
+    """
+    def __init__(self, db_path, pragmas, size):
+        self.db_path = db_path
+        self.pragmas = dict(pragmas)
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "closed": 0, "acquired": 0, "reused": 0}
+    
+    def _open(self):
+        # Connections move between threads when they are returned to the pool,
+        # but are only ever used by one thread at a time
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+            factory=InstrumentedConnection if app.config["METRICS_ENABLED"]
+            or app.config["SLOW_QUERY_SECONDS"] is not None
+            else sqlite3.Connection
         )
-    if not is_email_valid(email):
-        return respond_invalid_email_received()
-    try:
-        conn = connect_to_db()
-        cur = conn.cursor()
-        cur.execute(SqlQueries.ADD_EMAIL, (email,))
-        conn.commit()
-        return respond_success()
-    except sqlite3.IntegrityError as err:
-        message = err.args[0]
-        if "unique constraint" in message.lower():
-            return create_json_response(is_success=False,
-                error="Email already exists"
+        version = conn.execute("PRAGMA user_version;").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            conn.close()
+            raise RuntimeError(f"{self.db_path} is at schema version {version}, "
+                f"expected {SCHEMA_VERSION} (run db-structure.py to migrate)"
             )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        with self._lock:
+            self._stats["opened"] += 1
+        return conn
+    
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = self._open()
+            reused = False
+        with self._lock:
+            self._stats["acquired"] += 1
+            self._stats["reused"] += reused
+        return conn
+    
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
         else:
-            return create_json_response(is_success=False,
-                error="Unexpected SQLite integrity error"
-            )
-    finally:
+            self._close(conn)
+    
+    def _close(self, conn):
         conn.close()
+        with self._lock:
+            self._stats["closed"] += 1
+    
+    def close_all(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["idle"] = self._idle.qsize()
+        stats["in_use"] = stats["opened"] - stats["closed"] - stats["idle"]
+        return stats
 
 
-@app.post("/friend")
-def add_friends():
-    req = request.get_json()
-    if req is None:
-        return respond_no_json_received()
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path=None):
+    db_path = db_path or app.config["DB_PATH"]
+    with _pools_lock:
+        if db_path not in _pools:
+            _pools[db_path] = ConnectionPool(db_path,
+                pragmas=app.config["DB_PRAGMAS"],
+                size=app.config["DB_POOL_SIZE"],
+            )
+        return _pools[db_path]
+
+
+def connect_to_db(db_path=None):
+    """Get a pooled connection for the current request.
+
+    The same connection is returned for every call within one request and is
+    handed back to the pool when the app context is torn down, so callers must
+    not close it.
+    """
+    pool = get_pool(db_path)
+    conns = g.setdefault("db_connections", {})
+    if pool.db_path not in conns:
+        conns[pool.db_path] = pool.acquire()
+    return conns[pool.db_path]
+
+
+@app.teardown_appcontext
+def release_db_connections(exc):
+    for db_path, conn in g.pop("db_connections", {}).items():
+        _pools[db_path].release(conn)
+
+
+def stream_with_db(gen):
+    """Wrap generator gen, which may use the request's pooled connections, as
+    a streamed response body.
+
+    The app context is torn down as soon as the view returns, before the body
+    is generated, so the connections are held back from the pool until gen
+    is finished instead of being handed to another request while in use.
+    """
+    held = g.pop("db_connections", {})
+    
+    def generate():
+        g.db_connections = held
+        try:
+            yield from gen
+        finally:
+            release_db_connections(None)
+    
+    return stream_with_context(generate())
+
+
+def shard_path(index):
+    return sharding.shard_paths(app.config["DB_PATH"], app.config["SHARD_COUNT"])[index]
+
+
+def connect_to_shard(index):
+    """Get the pooled connection to shard index for the current request, as
+    connect_to_db; shard 0 is the database at DB_PATH, which connect_to_db
+    returns by default (see sharding.py)
+    """
+    return connect_to_db(shard_path(index))
+
+
+def shard_connections():
+    return [connect_to_shard(index) for index in range(app.config["SHARD_COUNT"])]
+
+
+def home_db(email_id):
+    """Connection to the shard holding every relationship of a user"""
+    return connect_to_shard(sharding.shard_of(email_id, app.config["SHARD_COUNT"]))
+
+
+def pair_db(email_id1, email_id2):
+    """Connection to the shard checking and committing writes between two
+    users
+    """
+    return connect_to_shard(
+        sharding.pair_shard_of(email_id1, email_id2, app.config["SHARD_COUNT"])
+    )
+
+
+class EmailIdCache:
+    """Bounded LRU cache of email -> email_id.
+
+    Emails known not to be in the database are cached as None, so repeated
+    lookups of unknown emails (e.g. mentions) also skip the database.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+        # Incremented by invalidate and clear
+        self._version = 0
+    
+    def version(self):
+        """Read before looking an email up in the database, and pass to put"""
+        with self._lock:
+            return self._version
+    
+    def get(self, email):
+        """Return (is_cached, email_id)"""
+        with self._lock:
+            try:
+                email_id = self._entries[email]
+            except KeyError:
+                self._stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end(email)
+            self._stats["hits"] += 1
+            return True, email_id
+    
+    def put(self, email, email_id, version=None):
+        with self._lock:
+            # A lookup that found nothing may race with the insert of the same
+            # email, so never let a negative result overwrite an id, or outlive
+            # an invalidation made since the lookup started
+            if email_id is None and (email in self._entries
+                or version is not None and version != self._version
+            ):
+                return
+            self._entries[email] = email_id
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+    
+    def invalidate(self, email):
+        with self._lock:
+            self._version += 1
+            self._entries.pop(email, None)
+    
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "size": len(self._entries)}
+
+
+email_id_cache = EmailIdCache(app.config["EMAIL_ID_CACHE_SIZE"])
+
+registry.gauge_collector("db_pool_connections",
+    "Connection pool counters, by statistic", "stat", lambda: get_pool().stats()
+)
+registry.gauge_collector("email_id_cache",
+    "Email id cache counters, by statistic", "stat", email_id_cache.stats
+)
+
+cached_results = result_cache.ResultCache(app.config["RESULT_CACHE_MAX_BYTES"])
+
+registry.gauge_collector("result_cache",
+    "Result cache counters, by statistic", "stat", cached_results.stats
+)
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_graph():
+    """Get the in-memory social graph, loading it from the database on first
+    use, or None if the graph engine is disabled.
+
+    Write handlers apply their changes to the graph only after committing them
+    to the database.
+    """
+    global _graph
+    if not app.config["GRAPH_ENGINE_ENABLED"]:
+        return None
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                _graph = load_graph(connect_to_db())
+    return _graph
+
+
+def load_graph(conn):
+    """Load the graph engine's graph from the snapshot at GRAPH_SNAPSHOT_PATH,
+    if set and no change has been made to the database since it was written,
+    or else from the database
+    """
+    path = app.config["GRAPH_SNAPSHOT_PATH"]
+    if path is not None and app.config["SHARD_COUNT"] > 1:
+        app.logger.warning("Graph snapshots are not used with SHARD_COUNT > 1")
+    elif path is not None:
+        try:
+            snapshot = csr_snapshot.Snapshot(path)
+        except ValueError as err:
+            # e.g. written by an older version
+            app.logger.warning("Graph snapshot not loaded: %s", err)
+        else:
+            if snapshot.last_change_id == csr_snapshot.last_change_id(conn):
+                return hide_pending_deletions(graph_engine.SnapshotGraph(snapshot))
+            app.logger.warning("Graph snapshot %s is out of date, loading the "
+                "graph from the database instead", path
+            )
+    return hide_pending_deletions(
+        graph_engine.SocialGraph.from_db(*shard_connections())
+    )
+
+
+def hide_pending_deletions(graph):
+    """Leave the users whose deletion is pending out of graph; returns graph"""
+    for email_id in get_pending_deletions(connect_to_db()):
+        graph.remove_user(email_id)
+    return graph
+
+
+# Name of the graph method applying a committed change, by (table, is_added)
+_GRAPH_UPDATES = {
+    ("friend", True): "add_friend",
+    ("friend", False): "remove_friend",
+    ("subscription", True): "add_subscription",
+    ("subscription", False): "remove_subscription",
+    ("block", True): "add_block",
+    ("block", False): "remove_block",
+}
+
+
+def publish_edge_changes(table, edges, is_added):
+    """Apply committed inserts into (or deletes from) table of edges, as
+    (email_id, email_id) rows, to the in-memory graph and result cache
+    """
+    graph = get_graph()
+    if graph is not None:
+        update = getattr(graph, _GRAPH_UPDATES[table, is_added])
+        for edge in edges:
+            update(*edge)
+    if table == "friend":
+        cached_results.bump(*itertools.chain.from_iterable(edges))
+    else:
+        # Subscriptions and blocks only change the target's audience
+        cached_results.bump(*(target_id for _, target_id in edges))
+
+
+def get_cached(key, email_ids, compute):
+    """Return compute(), cached under key if the result cache is enabled;
+    the result must depend only on the relationships of users email_ids
+    """
+    if not app.config["RESULT_CACHE_ENABLED"]:
+        return compute()
+    return cached_results.get_or_compute(key, email_ids, compute)
+
+
+# db_path -> ChangeLogFollower, one per shard
+change_log_followers = {}
+
+
+def get_change_log_followers():
+    """Get the followers of the change_log of each shard, creating them on
+    first use
+    """
+    paths = sharding.shard_paths(app.config["DB_PATH"], app.config["SHARD_COUNT"])
+    for path in paths:
+        if path not in change_log_followers:
+            change_log_followers.setdefault(path, change_log.ChangeLogFollower(
+                lambda path=path: sqlite3.connect(path, check_same_thread=False),
+                app.config["CHANGE_LOG_MAX_REPLAY"]
+            ))
+    return [change_log_followers[path] for path in paths]
+
+
+def get_change_log_stats():
+    """Counters of the change log followers of all shards, summed"""
+    totals = collections.Counter()
+    for follower in get_change_log_followers():
+        totals.update(follower.stats())
+    return dict(totals)
+
+
+registry.gauge_collector("change_log",
+    "Change log sync counters, by statistic", "stat", get_change_log_stats
+)
+
+
+def apply_logged_changes(changes):
+    """Apply changes committed by any process, as read from change_log, to the
+    caches and graph engine. Changes this process made itself were already
+    applied, and applying them again in commit order does no harm.
+    """
+    for (table, is_added), group in itertools.groupby(changes,
+        key=lambda change: (change.table_name, bool(change.is_added))
+    ):
+        if table == "email":
+            for change in group:
+                email_id_cache.invalidate(change.email)
+                if _graph is not None:
+                    _graph.add_email(change.email_id1, change.email)
+        elif table == "deletion":
+            for change in group:
+                forget_user(change.email_id1, change.email)
+        else:
+            publish_edge_changes(table,
+                [(change.email_id1, change.email_id2) for change in group], is_added
+            )
+
+
+def reset_caches():
+    """Drop the caches and graph engine, to be rebuilt from the database"""
+    global _graph
+    email_id_cache.clear()
+    cached_results.clear()
+    with _graph_lock:
+        _graph = None
+
+
+@app.before_request
+def sync_changes():
+    if app.config["CHANGE_LOG_SYNC_ENABLED"]:
+        for follower in get_change_log_followers():
+            follower.sync(apply_logged_changes, reset_caches)
+
+
+def trim_change_logs(keep):
+    """Delete all but the latest keep changes from change_log on each shard;
+    returns the number of changes deleted
+    """
+    deleted = 0
+    for conn in shard_connections():
+        cur = conn.execute(SqlQueries.TRIM_CHANGE_LOG, (keep,))
+        conn.commit()
+        deleted += cur.rowcount
+    return deleted
+
+
+write_requests = itertools.count(1)
+
+
+@app.after_request
+def trim_change_log_now_and_then(response):
+    every = app.config["CHANGE_LOG_TRIM_EVERY"]
+    if request.method not in ("GET", "HEAD") and every and (
+        next(write_requests) % every == 0
+    ):
+        trim_change_logs(app.config["CHANGE_LOG_KEEP"])
+    return response
+
+
+def create_json_response(is_success=False, **kwargs):
+    """Respond with a JSON object, or a MessagePack map if msgpack is installed
+    and the request's Accept header prefers it
+    """
+    started = time.perf_counter()
+    payload = {"success": is_success, **kwargs}
+    if msgpack is None:
+        response = jsonify(payload)
+    else:
+        mimetype = request.accept_mimetypes.best_match(
+            ["application/json", *MSGPACK_MIMETYPES]
+        )
+        if mimetype in MSGPACK_MIMETYPES:
+            response = Response(msgpack.packb(payload), mimetype=mimetype)
+        else:
+            response = jsonify(payload)
+        response.vary.add("Accept")
+    observe_phase("serialize", started)
+    return response
+
+
+def respond_success():
+    return create_json_response(is_success=True)
+
+
+def respond_error(message):
+    return create_json_response(is_success=False, error=message)
+
+
+def respond_no_json_received():
+    return respond_error(ErrorMessages.NO_JSON)
+
+
+def respond_invalid_email_received():
+    return respond_error(ErrorMessages.INVALID_EMAIL)
+
+
+def find_mentions(text):
+    """Get all email addresses in text"""
+    started = time.perf_counter()
+    mentions = EMAIL_REGEX.findall(text)
+    observe_phase("regex", started)
+    return mentions
+
+
+def find_mentions_in_texts(texts):
+    """Get a list of the email addresses in each of texts, scanning them all
+    in one pass
+    """
+    started = time.perf_counter()
+    # Matches never span a newline, so each lies within one of the texts
+    offsets = list(itertools.accumulate((len(text) + 1 for text in texts),
+        initial=0
+    ))
+    mentions = [[] for _ in texts]
+    for match in EMAIL_REGEX.finditer("\n".join(texts)):
+        mentions[bisect.bisect_right(offsets, match.start()) - 1].append(
+            match.group(1)
+        )
+    observe_phase("regex", started)
+    return mentions
+
+
+def is_email_valid(email_str):
+    """Validate email address. Currently only checks against a simple regex.
+    """
+    if not isinstance(email_str, str):
+        return False
+    match = EMAIL_REGEX.fullmatch(email_str)
+    return match is not None
+
+
+def parse_email_request(req):
+    """Get a valid email from request JSON with key 'email'.
+
+    Returns (email, None), or (None, error message) if the request is invalid.
+    """
+    try:
+        email = req["email"]
+    except (KeyError, TypeError):
+        return None, ErrorMessages.NO_EMAIL
+    if not is_email_valid(email):
+        return None, ErrorMessages.INVALID_EMAIL
+    return email, None
+
+
+def parse_friends_request(req):
+    """Get two distinct valid emails from request JSON with array key
+    'friends'; any emails after the first two are ignored.
+
+    Returns ((email1, email2), None), or (None, error message) if the request
+    is invalid.
+    """
     try:
         emails = req["friends"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="No email addresses received (JSON key should be 'friends', "
-            "email addresses should be in array value)"
-        )
-    # Take just first two emails from json array only if they are valid
+    except (KeyError, TypeError):
+        return None, ErrorMessages.NO_FRIENDS
+    if not isinstance(emails, list):
+        return None, ErrorMessages.NO_FRIENDS
     if ((len(emails) < 2) or emails[0] == emails[1]):
+        return None, ErrorMessages.TWO_EMAILS_REQUIRED
+    if (not is_email_valid(emails[0])) or (not is_email_valid(emails[1])):
+        return None, ErrorMessages.INVALID_EMAIL
+    return (emails[0], emails[1]), None
+
+
+def parse_requestor_target_request(req):
+    """Get valid emails from request JSON with keys 'requestor' and 'target'.
+
+    Returns ((requestor, target), None), or (None, error message) if the
+    request is invalid.
+    """
+    try:
+        req_email = req["requestor"]
+        target_email = req["target"]
+    except (KeyError, TypeError):
+        return None, ErrorMessages.NO_REQUESTOR_TARGET
+    if (not is_email_valid(req_email)) or (not is_email_valid(target_email)):
+        return None, ErrorMessages.INVALID_EMAIL
+    return (req_email, target_email), None
+
+
+def get_email_id(conn, email):
+    """Get email_id of email, or None if email is not in database"""
+    is_cached, email_id = email_id_cache.get(email)
+    if is_cached:
+        return email_id
+    version = email_id_cache.version()
+    cur = conn.cursor()
+    cur.execute(SqlQueries.CHECK_IF_EXISTS, (email,))
+    row = cur.fetchone()
+    cur.close()
+    email_id = row[0] if row is not None else None
+    email_id_cache.put(email, email_id, version)
+    return email_id
+
+
+def get_email_ids(conn, emails):
+    """Get dict of email -> email_id (None if not in database) for emails,
+    looking up all uncached emails in a single query.
+    """
+    email_ids = {}
+    uncached = []
+    for email in set(emails):
+        is_cached, email_id = email_id_cache.get(email)
+        if is_cached:
+            email_ids[email] = email_id
+        else:
+            uncached.append(email)
+    if uncached:
+        version = email_id_cache.version()
+        cur = conn.cursor()
+        cur.execute(SqlQueries.GET_EMAIL_IDS, (json.dumps(uncached),))
+        found = dict(cur.fetchall())
+        cur.close()
+        for email in uncached:
+            email_ids[email] = found.get(email)
+            email_id_cache.put(email, email_ids[email], version)
+    return email_ids
+
+
+def does_email_exist(conn, email):
+    return get_email_id(conn, email) is not None
+
+
+def friend_edge(email_id1, email_id2):
+    """Order a pair of email_ids the way the friend table stores them"""
+    return (email_id1, email_id2) if email_id1 < email_id2 else (email_id2, email_id1)
+
+
+def are_users_blocking(conn, blocker_id, blocked_id):
+    cur = conn.cursor()
+    cur.execute(SqlQueries.CHECK_IF_BLOCKING, (blocker_id, blocked_id))
+    res = cur.fetchone() is not None
+    cur.close()
+    return res
+
+
+def write_if_allowed(conn, query, diagnose_query, params):
+    """Run one of the conditional ..._IF_ALLOWED inserts and, only if it
+    inserted nothing, its DIAGNOSE_ query in the same transaction; commit.
+
+    Returns None if the row was inserted, or else the tuple of booleans from
+    the DIAGNOSE_ query, which sees the rows that stopped the insert.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(query, params)
+        failed_checks = None
+        if cur.rowcount != 1:
+            cur.execute(diagnose_query, params)
+            failed_checks = tuple(bool(value) for value in cur.fetchone())
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return failed_checks
+
+
+def get_friend_list(conn, email_id):
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_FRIEND_LIST, (email_id, email_id))
+    friend_list = [item[0] for item in cur.fetchall()]
+    cur.close()
+    return friend_list
+
+
+def get_friend_ids(conn, email_id, limit=None):
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_FRIEND_IDS,
+        (email_id, email_id, -1 if limit is None else limit)
+    )
+    friend_ids = [item[0] for item in cur.fetchall()]
+    cur.close()
+    return friend_ids
+
+
+def get_friend_count(conn, email_id):
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_FRIEND_COUNT, (email_id,))
+    count = cur.fetchone()[0]
+    cur.close()
+    return count
+
+
+def get_subscriber_count(conn, email_id):
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_SUBSCRIBER_COUNT, (email_id,))
+    count = cur.fetchone()[0]
+    cur.close()
+    return count
+
+
+def get_common_friends_list(conn, email_ids, count_only=False):
+    """Get friends common to all users in email_ids (or just their number if
+    count_only), walking the friend list of the user with fewest friends.
+
+    conn is the directory; friend lists kept on different shards are
+    intersected here rather than in SQL.
+    """
+    email_ids = set(email_ids)
+    home_conns = {home_db(email_id) for email_id in email_ids}
+    if len(home_conns) > 1:
+        mutual_ids = set.intersection(*(
+            set(get_friend_ids(home_db(email_id), email_id))
+            for email_id in email_ids
+        ))
+        if count_only:
+            return len(mutual_ids)
+        return list(get_emails(conn, mutual_ids).values())
+    conn, = home_conns
+    first_id = min(email_ids, key=lambda email_id: get_friend_count(conn, email_id))
+    other_ids = json.dumps(list(email_ids - {first_id}))
+    cur = conn.cursor()
+    if count_only:
+        cur.execute(SqlQueries.COUNT_COMMON_FRIENDS, (first_id, first_id, other_ids))
+        res = cur.fetchone()[0]
+    else:
+        cur.execute(SqlQueries.GET_COMMON_FRIENDS, (first_id, first_id, other_ids))
+        res = [item[0] for item in cur.fetchall()]
+    cur.close()
+    return res
+
+
+def get_subscriber_list(conn, email_id):
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_SUBSCRIBER_LIST, (email_id,))
+    subscriber_list = [item[0] for item in cur.fetchall()]
+    cur.close()
+    return subscriber_list
+
+
+def get_blocker_list(conn, email_id):
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_BLOCKER_LIST, (email_id,))
+    blocker_list = [item[0] for item in cur.fetchall()]
+    cur.close()
+    return blocker_list
+
+
+def find_edges(conn, query, pairs):
+    """Get the set of pairs of email_ids which exist in the table searched by
+    query (one of the SqlQueries.FIND_* statements), in a single query
+    """
+    if not pairs:
+        return set()
+    cur = conn.cursor()
+    cur.execute(query, (json.dumps(list(pairs)),))
+    edges = set(cur.fetchall())
+    cur.close()
+    return edges
+
+
+def ensure_email_rows(conn, email_ids):
+    """Copy the email rows of email_ids from the directory to the shard open
+    on conn, where missing, and commit; every user with a relationship stored
+    on a shard needs a row there (see sharding.py)
+    """
+    directory = connect_to_db()
+    if conn is directory:
+        return
+    missing = set(email_ids).difference(get_emails(conn, email_ids))
+    if missing:
+        cur = conn.cursor()
+        cur.executemany(SqlQueries.ADD_EMAIL_WITH_ID,
+            get_emails(directory, missing).items()
+        )
+        cur.close()
+        conn.commit()
+
+
+# For each relationship table: query finding pairs, insert and delete
+# statements, and whether pairs are friend edges rather than directed
+_MIRRORED_TABLES = [
+    (SqlQueries.FIND_FRIENDS, SqlQueries.ESTABLISH_FRIEND_CONNECTION,
+        SqlQueries.UNFRIEND, True
+    ),
+    (SqlQueries.FIND_SUBSCRIPTIONS, SqlQueries.SUBSCRIBE_USER_TO_TARGET,
+        SqlQueries.UNSUBSCRIBE_USER_FROM_TARGET, False
+    ),
+    (SqlQueries.FIND_BLOCKS, SqlQueries.BLOCK_USER_TARGET,
+        SqlQueries.UNBLOCK_USER_TARGET, False
+    ),
+]
+
+
+def sync_mirrors(pairs):
+    """Make the mirror shard of each (email_id, email_id) pair hold the same
+    relationships between the two users as their pair shard (see
+    sharding.py); returns the number of rows changed.
+
+    Call after committing writes to the pair shard. The pair shard is read
+    while the mirror is locked, so that when writes to the same pair race,
+    the last copy made is of the latest state.
+    """
+    shard_count = app.config["SHARD_COUNT"]
+    by_shards = collections.defaultdict(set)
+    for email_id1, email_id2 in pairs:
+        pair = friend_edge(email_id1, email_id2)
+        source = sharding.pair_shard_of(*pair, shard_count)
+        mirror = sharding.shard_of(pair[1], shard_count)
+        if mirror != source:
+            by_shards[source, mirror].add(pair)
+    changed = 0
+    for (source, mirror), pairs in by_shards.items():
+        source_conn, mirror_conn = connect_to_shard(source), connect_to_shard(mirror)
+        ensure_email_rows(mirror_conn, {email_id for pair in pairs for email_id in pair})
+        directed = [edge for pair in pairs for edge in (pair, pair[::-1])]
+        mirror_conn.execute("BEGIN IMMEDIATE;")
+        try:
+            for find, insert, delete, is_friend_edge in _MIRRORED_TABLES:
+                edges = pairs if is_friend_edge else directed
+                expected = find_edges(source_conn, find, edges)
+                present = find_edges(mirror_conn, find, edges)
+                cur = mirror_conn.cursor()
+                cur.executemany(insert, expected - present)
+                cur.executemany(delete, present - expected)
+                cur.close()
+                changed += len(expected ^ present)
+            mirror_conn.commit()
+        except BaseException:
+            mirror_conn.rollback()
+            raise
+    return changed
+
+
+def encode_cursor(email_id):
+    return base64.urlsafe_b64encode(str(email_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Get email_id from a cursor made by encode_cursor, or None if invalid"""
+    try:
+        email_id = int(base64.urlsafe_b64decode(cursor.encode()))
+    except (AttributeError, ValueError):
+        return None
+    return email_id if email_id >= 0 else None
+
+
+def parse_limit(req, default_limit=None):
+    """Get optional key 'limit' from request JSON; returns (limit, None),
+    where limit is None for no limit, or (None, error message)
+    """
+    max_limit = app.config["MAX_PAGE_SIZE"]
+    limit = req.get("limit", default_limit)
+    if limit is not None and (
+        isinstance(limit, bool) or not isinstance(limit, int)
+        or not 0 < limit <= max_limit
+    ):
+        return None, ErrorMessages.INVALID_LIMIT.format(max_limit)
+    return limit, None
+
+
+def parse_page_request(req, default_limit=None):
+    """Get paging options from request JSON with optional keys 'limit', 'after'
+    (a cursor from a previous page's 'next') and 'stream'.
+
+    Returns ((limit, after, stream), None), where limit is None for no limit
+    and after is an email_id, or (None, error message) if the options are
+    invalid.
+    """
+    limit, error = parse_limit(req, default_limit)
+    if error is not None:
+        return None, error
+    after = 0
+    if req.get("after") is not None:
+        after = decode_cursor(req["after"])
+        if after is None:
+            return None, ErrorMessages.INVALID_CURSOR
+    return (limit, after, bool(req.get("stream", False))), None
+
+
+def iter_friend_page(conn, email_id, after=0, limit=None):
+    """Yield (email_id, email) of friends above cursor after, in email_id
+    order, as they come off the database cursor
+    """
+    limit = -1 if limit is None else limit
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_FRIEND_PAGE,
+        (email_id, after, email_id, after, limit)
+    )
+    yield from cur
+    cur.close()
+
+
+def iter_subscriber_page(conn, email_id, after=0, limit=None):
+    """Yield (email_id, email) of subscribers above cursor after, in email_id
+    order, as they come off the database cursor
+    """
+    limit = -1 if limit is None else limit
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_SUBSCRIBER_PAGE, (email_id, after, limit))
+    yield from cur
+    cur.close()
+
+
+def iter_graph_page(graph, email_ids, after=0, limit=None):
+    """Yield (email_id, email) for a page of an in-memory adjacency set"""
+    above = (email_id for email_id in email_ids if email_id > after)
+    if limit is None:
+        page = sorted(above)
+    else:
+        page = heapq.nsmallest(limit, above)
+    # Users deleted since email_ids was read have no email
+    yield from (row for row in zip(page, graph.to_emails(page))
+        if row[1] is not None
+    )
+
+
+def respond_page(key, rows, limit, stream, total, ids=False):
+    """Respond with the emails (or with ids, the email_ids) of (email_id,
+    email) rows as array key, plus 'count', 'total' (the number of items on
+    all pages) and, if limited, cursor 'next' for the following page (or null)
+
+    rows should yield up to limit + 1 items, so that it can be told whether
+    there is a following page. With stream, the JSON is sent in chunks as rows
+    are produced instead of being built in memory first.
+    """
+    if limit is not None:
+        rows = itertools.islice(rows, limit + 1)
+    if not stream:
+        rows = list(rows)
+        page = {}
+        if limit is not None:
+            is_last = len(rows) <= limit
+            rows = rows[:limit]
+            page["next"] = None if is_last else encode_cursor(rows[-1][0])
+        items = [row[0 if ids else 1] for row in rows]
+        return create_json_response(is_success=True,
+            **{key: items, "count": len(items), "total": total, **page}
+        )
+    
+    def generate():
+        yield f'{{"success": true, {json.dumps(key)}: ['
+        count = 0
+        last_id = None
+        for email_id, email in rows:
+            if count == limit:
+                break
+            yield ("," if count else "") + (str(email_id) if ids else json.dumps(email))
+            count += 1
+            last_id = email_id
+        else:
+            last_id = None
+        page = ""
+        if limit is not None:
+            page = f', "next": {json.dumps(last_id and encode_cursor(last_id))}'
+        yield f'], "count": {count}, "total": {total}{page}}}'
+    
+    return Response(stream_with_db(generate()), mimetype="application/json")
+
+
+def get_recipient_list(conn, sender_id, mentions):
+    mentions = json.dumps(list(set(mentions)))
+    cur = conn.cursor()
+    if app.config["AUDIENCE_TABLE_ENABLED"]:
+        cur.execute(SqlQueries.GET_RECIPIENTS_FROM_AUDIENCE,
+            (sender_id, mentions, sender_id)
+        )
+    else:
+        cur.execute(SqlQueries.GET_RECIPIENTS,
+            (sender_id, sender_id, sender_id, mentions, sender_id)
+        )
+    recipient_list = [item[0] for item in cur.fetchall()]
+    cur.close()
+    return recipient_list
+
+
+def get_recipient_ids(conn, sender_id, mention_ids):
+    """As get_recipient_list, as email_ids, for the email_ids of the mentioned
+    users
+    """
+    mention_ids = json.dumps(list(set(mention_ids)))
+    cur = conn.cursor()
+    if app.config["AUDIENCE_TABLE_ENABLED"]:
+        cur.execute(SqlQueries.GET_RECIPIENT_IDS_FROM_AUDIENCE,
+            (sender_id, mention_ids, sender_id)
+        )
+    else:
+        cur.execute(SqlQueries.GET_RECIPIENT_IDS,
+            (sender_id, sender_id, sender_id, mention_ids, sender_id)
+        )
+    recipient_ids = [item[0] for item in cur.fetchall()]
+    cur.close()
+    return recipient_ids
+
+
+def get_emails(conn, email_ids):
+    """Get dict of email_id -> email for email_ids"""
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_EMAILS, (json.dumps(list(email_ids)),))
+    emails = dict(cur.fetchall())
+    cur.close()
+    return emails
+
+
+def get_suggestions(conn, email_id, limit):
+    """Rank friends of friends of a user, other than the user's friends and
+    users in a block relation with the user either way, by mutual friends.
+
+    Returns ([(email_id, mutual friend count)], is_partial). Each hop follows
+    at most SUGGESTIONS_MAX_FANOUT friends, and the traversal stops after
+    SUGGESTIONS_TIME_BUDGET seconds; is_partial is True if either cut it
+    short, in which case counts may be too low.
+    """
+    max_fanout = app.config["SUGGESTIONS_MAX_FANOUT"]
+    deadline = time.perf_counter() + app.config["SUGGESTIONS_TIME_BUDGET"]
+    graph = get_graph()
+    if graph is not None:
+        def friends_of(friend_id, limit=None):
+            return list(itertools.islice(graph.friends_of(friend_id), limit))
+        is_blocking = graph.is_blocking
+    else:
+        def friends_of(friend_id, limit=None):
+            return get_friend_ids(home_db(friend_id), friend_id, limit)
+        def is_blocking(blocker_id, blocked_id):
+            return are_users_blocking(pair_db(blocker_id, blocked_id),
+                blocker_id, blocked_id
+            )
+    friend_ids = set(friends_of(email_id))
+    is_partial = len(friend_ids) > max_fanout
+    mutual_counts = collections.Counter()
+    for friend_id in itertools.islice(friend_ids, max_fanout):
+        if time.perf_counter() > deadline:
+            is_partial = True
+            break
+        # One more than the cap tells whether the cap was reached
+        friends_of_friend = friends_of(friend_id, max_fanout + 1)
+        is_partial = is_partial or len(friends_of_friend) > max_fanout
+        mutual_counts.update(friends_of_friend[:max_fanout])
+    # Pop the best candidates off a heap rather than sorting all of them, as
+    # only those popped need checking for blocks
+    candidates = [(-count, candidate_id)
+        for candidate_id, count in mutual_counts.items()
+        if candidate_id != email_id and candidate_id not in friend_ids
+    ]
+    heapq.heapify(candidates)
+    suggestions = []
+    while candidates and len(suggestions) < limit:
+        count, candidate_id = heapq.heappop(candidates)
+        if not (is_blocking(email_id, candidate_id)
+            or is_blocking(candidate_id, email_id)
+        ):
+            suggestions.append((candidate_id, -count))
+    return suggestions, is_partial
+
+
+_read_executor = None
+_read_executor_lock = threading.Lock()
+
+
+def run_reads(db_path, *reads):
+    """Run reads, functions of a connection, at the same time on pooled
+    connections of their own to db_path; returns their results in order.
+
+    Each read sees the database as of when it starts, so reads running
+    alongside a write may disagree about it, as separate requests would.
+    """
+    global _read_executor
+    if _read_executor is None:
+        with _read_executor_lock:
+            if _read_executor is None:
+                _read_executor = concurrent.futures.ThreadPoolExecutor(
+                    app.config["READ_THREADS"], thread_name_prefix="read"
+                )
+    pool = get_pool(db_path)
+    
+    def run(read):
+        conn = pool.acquire()
+        try:
+            return read(conn)
+        finally:
+            pool.release(conn)
+    
+    return list(_read_executor.map(run, reads))
+
+
+def get_audience(sender_id):
+    """Return (recipients of sender's updates before mentions, emails of
+    users blocking sender), both as frozensets; the cacheable part of
+    /notified
+    """
+    if not app.config["CONCURRENT_READS_ENABLED"]:
+        conn = home_db(sender_id)
+        return (
+            frozenset(get_recipient_list(conn, sender_id, [])),
+            frozenset(get_blocker_list(conn, sender_id)),
+        )
+    if app.config["AUDIENCE_TABLE_ENABLED"]:
+        reads = [lambda conn: get_recipient_list(conn, sender_id, [])]
+    else:
+        reads = [
+            lambda conn: get_friend_list(conn, sender_id),
+            lambda conn: get_subscriber_list(conn, sender_id),
+        ]
+    *recipient_lists, blockers = run_reads(
+        shard_path(sharding.shard_of(sender_id, app.config["SHARD_COUNT"])),
+        *reads, lambda conn: get_blocker_list(conn, sender_id)
+    )
+    blockers = frozenset(blockers)
+    return frozenset().union(*recipient_lists) - blockers, blockers
+
+
+def get_pending_deletions(conn):
+    """Get email_ids of the users whose deletion is pending"""
+    cur = conn.cursor()
+    cur.execute(SqlQueries.GET_PENDING_DELETIONS)
+    email_ids = [item[0] for item in cur.fetchall()]
+    cur.close()
+    return email_ids
+
+
+def forget_user(email_id, email):
+    """Drop a user whose deletion has been requested, by any process, from
+    the caches and graph engine
+    """
+    email_id_cache.invalidate(email)
+    # Any cached result may include the user
+    cached_results.clear()
+    if _graph is not None:
+        _graph.remove_user(email_id)
+
+
+# Statements deleting a batch of a user's rows, by relationship table
+_USER_ROW_DELETES = [
+    ("friend", SqlQueries.DELETE_USER_FRIENDS),
+    ("subscription", SqlQueries.DELETE_USER_SUBSCRIPTIONS),
+    ("block", SqlQueries.DELETE_USER_BLOCKS),
+]
+
+
+def delete_user_rows(conn, email_id, limit):
+    """Delete up to limit relationship rows of a user from the shard open on
+    conn, in one transaction; returns the number deleted
+    """
+    removed = {}
+    count = 0
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        cur = conn.cursor()
+        for table, query in _USER_ROW_DELETES:
+            if count == limit:
+                break
+            cur.execute(query, (email_id, email_id, limit - count))
+            removed[table] = cur.fetchall()
+            count += len(removed[table])
+        if count:
+            cur.execute(SqlQueries.ADD_REMOVED_ROWS, (count, email_id))
+        cur.close()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    for table, edges in removed.items():
+        if edges:
+            publish_edge_changes(table, edges, False)
+    return count
+
+
+def finish_deletion(email_id):
+    """Delete the email rows of a user with no relationship rows left, and
+    mark their deletion finished, on every shard
+    """
+    finished_at = time.time()
+    # The directory last, as the email can be added again from then on
+    for conn in reversed(shard_connections()):
+        cur = conn.cursor()
+        cur.execute(SqlQueries.DELETE_EMAIL, (email_id,))
+        cur.execute(SqlQueries.FINISH_DELETION, (finished_at, email_id))
+        cur.close()
+        conn.commit()
+
+
+def delete_user_batch():
+    """Delete up to DELETE_BATCH_SIZE relationship rows of the first user whose
+    deletion is pending, from one shard, or if none are left, finish their
+    deletion; returns False if no deletion is pending.
+
+    Called by the background deleter, on its own thread.
+    """
+    with app.app_context():
+        pending = get_pending_deletions(connect_to_db())
+        if not pending:
+            return False
+        email_id = pending[0]
+        for conn in shard_connections():
+            if delete_user_rows(conn, email_id, app.config["DELETE_BATCH_SIZE"]):
+                return True
+        finish_deletion(email_id)
+        return True
+
+
+_deleter = None
+_deleter_lock = threading.Lock()
+
+
+def get_deleter():
+    global _deleter
+    if _deleter is None:
+        with _deleter_lock:
+            if _deleter is None:
+                _deleter = background_deletion.BackgroundDeleter(delete_user_batch,
+                    app.config["DELETE_BATCH_DELAY"]
+                )
+    return _deleter
+
+
+registry.gauge_collector("background_deleter",
+    "Background deleter counters, by statistic", "stat",
+    lambda: get_deleter().stats()
+)
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(registry.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/pool_stats")
+def get_pool_stats():
+    return create_json_response(is_success=True, **get_pool().stats())
+
+
+@app.get("/cache_stats")
+def get_cache_stats():
+    return create_json_response(is_success=True,
+        email_id_cache=email_id_cache.stats(),
+        result_cache=cached_results.stats()
+    )
+
+
+@app.get("/graph_check")
+def check_graph():
+    graph = get_graph()
+    if graph is None:
         return create_json_response(is_success=False,
-            error="Two distinct valid email addresses required"
+            error="Graph engine is disabled"
         )
-    if (not is_email_valid(emails[0])) or (not is_email_valid(emails[1])):
-        return respond_invalid_email_received()
+    db_graph = hide_pending_deletions(
+        graph_engine.SocialGraph.from_db(*shard_connections())
+    )
+    diff = db_graph.diff(graph)
+    return create_json_response(is_success=True,
+        is_consistent=not (diff["missing"] or diff["unexpected"]),
+        **diff
+    )
+
+
+@app.post("/users")
+def add_email():
+    req = request.get_json()
+    if req is None:
+        return respond_no_json_received()
+    if app.config["WRITE_COALESCING_ENABLED"]:
+        return respond_coalesced_write(write_emails, req)
+    email, error = parse_email_request(req)
+    if error is not None:
+        return respond_error(error)
+    conn = connect_to_db()
+    try:
+        cur = conn.cursor()
+        cur.execute(SqlQueries.ADD_EMAIL, (email,))
+        conn.commit()
+        email_id_cache.put(email, cur.lastrowid)
+        ensure_email_rows(home_db(cur.lastrowid), [cur.lastrowid])
+        graph = get_graph()
+        if graph is not None:
+            graph.add_email(cur.lastrowid, email)
+        return respond_success()
+    except sqlite3.IntegrityError as err:
+        conn.rollback()
+        message = err.args[0]
+        if "unique constraint" in message.lower():
+            return respond_error(ErrorMessages.EMAIL_EXISTS)
+        else:
+            return respond_error(ErrorMessages.INTEGRITY_ERROR)
+
+
+@app.delete("/users")
+def delete_email():
+    req = request.get_json()
+    if req is None:
+        return respond_no_json_received()
+    email, error = parse_email_request(req)
+    if error is not None:
+        return respond_error(error)
+    email_id = get_email_id(connect_to_db(), email)
+    if email_id is None:
+        return respond_error(ErrorMessages.EMAIL_NOT_FOUND)
+    # Only the user's email is looked up and marked deleted here, however
+    # many relationships they have; the background deleter removes those
+    requested_at = time.time()
+    for conn in shard_connections():
+        cur = conn.cursor()
+        cur.execute(SqlQueries.ADD_DELETION, (email_id, email, requested_at))
+        cur.close()
+        conn.commit()
+    forget_user(email_id, email)
+    get_deleter().wake()
+    return respond_success()
+
+
+@app.get("/users/deletion")
+def get_deletion_status():
+    req = request.get_json()
+    if req is None:
+        return respond_no_json_received()
+    email, error = parse_email_request(req)
+    if error is not None:
+        return respond_error(error)
+    cur = connect_to_db().cursor()
+    cur.execute(SqlQueries.GET_DELETION, (email,))
+    row = cur.fetchone()
+    cur.close()
+    if row is None:
+        return respond_error(ErrorMessages.NO_DELETION)
+    email_id, requested_at, finished_at = row
+    removed_rows = remaining_rows = 0
+    for conn in shard_connections():
+        cur = conn.cursor()
+        cur.execute(SqlQueries.GET_REMOVED_ROWS, (email_id,))
+        removed_rows += cur.fetchone()[0]
+        if finished_at is None:
+            cur.execute(SqlQueries.COUNT_USER_ROWS, (email_id,) * 6)
+            remaining_rows += cur.fetchone()[0]
+        cur.close()
+    if finished_at is None:
+        # e.g. the server was restarted since the deletion was requested
+        get_deleter().wake()
+    return create_json_response(is_success=True,
+        is_finished=finished_at is not None,
+        requested_at=requested_at,
+        finished_at=finished_at,
+        removed_rows=removed_rows,
+        remaining_rows=remaining_rows
+    )
+
+
+@app.post("/friend")
+def add_friends():
+    req = request.get_json()
+    if req is None:
+        return respond_no_json_received()
+    if app.config["WRITE_COALESCING_ENABLED"]:
+        return respond_coalesced_write(write_friends, req)
+    emails, error = parse_friends_request(req)
+    if error is not None:
+        return respond_error(error)
     with connect_to_db() as conn:
-        if are_users_blocking(conn, emails[0], emails[1]):
-            return create_json_response(is_success=False,
-                error="At least one user is blocking the other"
-            )
-        if are_users_friends(conn, emails[0], emails[1]):
-            return create_json_response(is_success=False,
-                error="Users are already friends"
+        email_ids = get_email_ids(conn, emails[:2])
+        id1, id2 = email_ids[emails[0]], email_ids[emails[1]]
+        if id1 is None or id2 is None:
+            return respond_error(ErrorMessages.EMAILS_NOT_FOUND)
+        pair_conn = pair_db(id1, id2)
+        ensure_email_rows(pair_conn, (id1, id2))
+        params = (*friend_edge(id1, id2), id1, id2, id2, id1)
+        try:
+            failed_checks = write_if_allowed(pair_conn,
+                SqlQueries.ADD_FRIEND_IF_ALLOWED, SqlQueries.DIAGNOSE_FRIEND,
+                params
             )
+        except sqlite3.IntegrityError:
+            return respond_error(ErrorMessages.INTEGRITY_ERROR)
+        if failed_checks is None:
+            sync_mirrors([(id1, id2)])
+            publish_edge_changes("friend", [(id1, id2)], True)
+            return respond_success()
+        is_friend, is_blocking = failed_checks
+        if is_blocking:
+            return respond_error(ErrorMessages.USERS_BLOCKING)
         else:
-            try:
-                cur = conn.cursor()
-                cur.execute(
-                    SqlQueries.ESTABLISH_FRIEND_CONNECTION,
-                    (emails[0], emails[1]),
-                )
-                conn.commit()
-                return respond_success()
-            except sqlite3.IntegrityError as err:
-                message = err.args[0]
-                # We had checked for existing friend connection already
-                return create_json_response(is_success=False,
-                    error="Unexpected SQLite integrity error"
-                )
+            return respond_error(ErrorMessages.ALREADY_FRIENDS)
 
 
 @app.post("/unfriend")
@@ -297,51 +2386,163 @@ def remove_friends():
     req = request.get_json()
     if req is None:
         return respond_no_json_received()
-    try:
-        emails = req["friends"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="No email addresses received (JSON key should be 'friends', "
-            "email addresses should be in array value)"
-        )
-    # Take just first two emails from json array only if they are valid
-    if ((len(emails) < 2) or emails[0] == emails[1]):
-        return create_json_response(is_success=False,
-            error="Two distinct valid email addresses required"
-        )
-    if (not is_email_valid(emails[0])) or (not is_email_valid(emails[1])):
-        return respond_invalid_email_received()
+    if app.config["WRITE_COALESCING_ENABLED"]:
+        return respond_coalesced_write(write_unfriends, req)
+    emails, error = parse_friends_request(req)
+    if error is not None:
+        return respond_error(error)
     with connect_to_db() as conn:
-        cur = conn.cursor()
-        cur.execute(SqlQueries.UNFRIEND, (emails[0], emails[1], emails[0], emails[1]))
-        conn.commit()
+        email_ids = get_email_ids(conn, emails[:2])
+        id1, id2 = email_ids[emails[0]], email_ids[emails[1]]
+        if id1 is not None and id2 is not None:
+            pair_conn = pair_db(id1, id2)
+            cur = pair_conn.cursor()
+            cur.execute(SqlQueries.UNFRIEND, friend_edge(id1, id2))
+            pair_conn.commit()
+            sync_mirrors([(id1, id2)])
+            publish_edge_changes("friend", [(id1, id2)], False)
         return respond_success()
 
 
-@app.get("/friend_list")
-def get_friends_of_user():
+@app.get("/friend_list")
+def get_friends_of_user():
+    req = request.get_json()
+    if req is None:
+        return respond_no_json_received()
+    email, error = parse_email_request(req)
+    if error is not None:
+        return respond_error(error)
+    page, error = parse_page_request(req)
+    if error is not None:
+        return respond_error(error)
+    limit, after, stream = page
+    ids = bool(req.get("ids", False))
+    key = "friend_ids" if ids else "friends"
+    with connect_to_db() as conn:
+        email_id = get_email_id(conn, email)
+        graph = get_graph()
+        if email_id is None:
+            return respond_error(ErrorMessages.EMAIL_NOT_FOUND)
+        elif limit is None and not stream:
+            if graph is not None and ids:
+                friend_list = list(graph.friends_of(email_id))
+            elif graph is not None:
+                friend_list = graph.to_emails(graph.friends_of(email_id))
+            elif ids:
+                friend_list = get_cached(("friend_ids", email_id), [email_id],
+                    lambda: tuple(get_friend_ids(home_db(email_id), email_id))
+                )
+            else:
+                friend_list = get_cached(("friends", email_id), [email_id],
+                    lambda: tuple(get_friend_list(home_db(email_id), email_id))
+                )
+            return create_json_response(is_success=True,
+                **{key: friend_list, "count": len(friend_list)}
+            )
+        elif graph is not None:
+            friend_ids = graph.friends_of(email_id)
+            rows = iter_graph_page(graph, friend_ids, after, limit and limit + 1)
+            total = len(friend_ids)
+        else:
+            home_conn = home_db(email_id)
+            rows = iter_friend_page(home_conn, email_id, after, limit and limit + 1)
+            total = get_friend_count(home_conn, email_id)
+        return respond_page(key, rows, limit, stream, total, ids)
+
+
+@app.get("/users/stats")
+def get_user_stats():
+    req = request.get_json()
+    if req is None:
+        return respond_no_json_received()
+    if not isinstance(req, dict):
+        return respond_error(ErrorMessages.NO_EMAILS)
+    emails = req.get("emails", [req["email"]] if "email" in req else None)
+    if not isinstance(emails, list) or not emails:
+        return respond_error(ErrorMessages.NO_EMAILS)
+    if not all(is_email_valid(email) for email in emails):
+        return respond_invalid_email_received()
+    with connect_to_db() as conn:
+        if app.config["SHARD_COUNT"] > 1:
+            # Counts are only complete on each user's home shard
+            by_shard = collections.defaultdict(list)
+            for email, email_id in get_email_ids(conn, emails).items():
+                if email_id is not None:
+                    by_shard[home_db(email_id)].append(email)
+        else:
+            by_shard = {conn: emails}
+        stats = {}
+        for shard_conn, shard_emails in by_shard.items():
+            cur = shard_conn.cursor()
+            cur.execute(SqlQueries.GET_USER_STATS, (json.dumps(shard_emails),))
+            stats.update(
+                (email, {"friend_count": friends,
+                    "subscriber_count": subscribers,
+                    "blocked_by_count": blockers})
+                for email, friends, subscribers, blockers in cur.fetchall()
+            )
+            cur.close()
+        if len(stats) < len(set(emails)):
+            return respond_error(ErrorMessages.EMAILS_NOT_FOUND)
+        return create_json_response(is_success=True, stats=stats)
+
+
+@app.get("/users/resolve")
+def resolve_users():
     req = request.get_json()
     if req is None:
         return respond_no_json_received()
-    try:
-        email = req["email"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="No email address received (JSON key should be 'email')"
+    if not isinstance(req, dict):
+        return respond_error(ErrorMessages.NO_RESOLVE_KEYS)
+    emails = req.get("emails")
+    email_ids = req.get("email_ids")
+    if isinstance(emails, list) and email_ids is None:
+        if not all(is_email_valid(email) for email in emails):
+            return respond_invalid_email_received()
+        with connect_to_db() as conn:
+            found = get_email_ids(conn, emails)
+        return create_json_response(is_success=True,
+            email_ids=[found[email] for email in emails]
         )
-    if not is_email_valid(email):
-        return respond_invalid_email_received()
+    elif isinstance(email_ids, list) and emails is None:
+        if not all(isinstance(email_id, int) and not isinstance(email_id, bool)
+            for email_id in email_ids
+        ):
+            return respond_error(ErrorMessages.NO_RESOLVE_KEYS)
+        with connect_to_db() as conn:
+            found = get_emails(conn, email_ids)
+        return create_json_response(is_success=True,
+            emails=[found.get(email_id) for email_id in email_ids]
+        )
+    return respond_error(ErrorMessages.NO_RESOLVE_KEYS)
+
+
+@app.get("/subscribers")
+def get_subscribers_of_user():
+    req = request.get_json()
+    if req is None:
+        return respond_no_json_received()
+    email, error = parse_email_request(req)
+    if error is not None:
+        return respond_error(error)
+    page, error = parse_page_request(req, app.config["DEFAULT_PAGE_SIZE"])
+    if error is not None:
+        return respond_error(error)
+    limit, after, stream = page
     with connect_to_db() as conn:
-        if does_email_exist(conn, email):
-            friend_list = get_friend_list(conn, email)
-            return create_json_response(is_success=True,
-                friends=friend_list,
-                count=len(friend_list)
-            )
+        email_id = get_email_id(conn, email)
+        if email_id is None:
+            return respond_error(ErrorMessages.EMAIL_NOT_FOUND)
+        graph = get_graph()
+        if graph is not None:
+            subscriber_ids = graph.subscribers_of(email_id)
+            rows = iter_graph_page(graph, subscriber_ids, after, limit + 1)
+            total = len(subscriber_ids)
         else:
-            return create_json_response(is_success=False,
-                error="Email does not exist"
-            )
+            home_conn = home_db(email_id)
+            rows = iter_subscriber_page(home_conn, email_id, after, limit + 1)
+            total = get_subscriber_count(home_conn, email_id)
+        return respond_page("subscribers", rows, limit, stream, total)
 
 
 @app.get("/common_friends")
@@ -351,33 +2552,84 @@ def get_common_friends():
         return respond_no_json_received()
     try:
         emails = req["friends"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="No email addresses received (JSON key should be 'friends', "
-            "email addresses should be in array value)"
-        )
-    # Take just first two emails from json array only if they are valid
+    except (KeyError, TypeError):
+        return respond_error(ErrorMessages.NO_FRIENDS)
+    if not isinstance(emails, list):
+        return respond_error(ErrorMessages.NO_FRIENDS)
+    count_only = bool(req.get("count_only", False))
+    # Common friends of all emails in the json array, if they are all valid
     if len(emails) < 2:
-        return create_json_response(is_success=False,
-            error="Two distinct valid email addresses required"
-        )
-    if (not is_email_valid(emails[0])) or (not is_email_valid(emails[1])):
+        return respond_error(ErrorMessages.TWO_EMAILS_REQUIRED)
+    if not all(is_email_valid(email) for email in emails):
         return respond_invalid_email_received()
     with connect_to_db() as conn:
-        if (does_email_exist(conn, emails[0])
-            and does_email_exist(conn, emails[1])
-        ):
-            mutual_friends = set(get_friend_list(conn, emails[0])).intersection(
-                set(get_friend_list(conn, emails[1]))
-            )
+        email_ids = get_email_ids(conn, emails)
+        graph = get_graph()
+        if None in email_ids.values():
+            return respond_error(ErrorMessages.EMAILS_NOT_FOUND)
+        elif graph is not None:
+            mutual_ids = graph.common_friends(email_ids.values())
+            if count_only:
+                return create_json_response(is_success=True,
+                    count=len(mutual_ids)
+                )
+            mutual_friends = graph.to_emails(mutual_ids)
+        elif count_only:
             return create_json_response(is_success=True,
-                friends=list(mutual_friends),
-                count=len(mutual_friends)
+                count=get_cached(
+                    ("common_friends_count", frozenset(email_ids.values())),
+                    email_ids.values(),
+                    lambda: get_common_friends_list(conn, email_ids.values(),
+                        count_only=True
+                    )
+                )
             )
         else:
-            return create_json_response(is_success=False,
-                error="One or both of the provided emails does not exist."
+            mutual_friends = get_cached(
+                ("common_friends", frozenset(email_ids.values())),
+                email_ids.values(),
+                lambda: tuple(get_common_friends_list(conn, email_ids.values()))
             )
+        return create_json_response(is_success=True,
+            friends=list(mutual_friends),
+            count=len(mutual_friends)
+        )
+
+
+@app.get("/suggestions")
+def get_suggested_friends():
+    req = request.get_json()
+    if req is None:
+        return respond_no_json_received()
+    email, error = parse_email_request(req)
+    if error is not None:
+        return respond_error(error)
+    limit, error = parse_limit(req, app.config["DEFAULT_SUGGESTIONS"])
+    if error is not None:
+        return respond_error(error)
+    with connect_to_db() as conn:
+        email_id = get_email_id(conn, email)
+        if email_id is None:
+            return respond_error(ErrorMessages.EMAIL_NOT_FOUND)
+        suggestions, is_partial = get_suggestions(conn, email_id, limit)
+        graph = get_graph()
+        if graph is not None:
+            emails = dict(zip((item[0] for item in suggestions),
+                graph.to_emails(item[0] for item in suggestions)
+            ))
+        else:
+            emails = get_emails(conn, (item[0] for item in suggestions))
+        suggestions = [
+            {"email": emails[suggested_id], "mutual_friends": count}
+            for suggested_id, count in suggestions
+            # Unless deleted since they were found
+            if emails.get(suggested_id) is not None
+        ]
+        return create_json_response(is_success=True,
+            suggestions=suggestions,
+            count=len(suggestions),
+            partial=is_partial
+        )
 
 
 @app.post("/subscribe")
@@ -385,46 +2637,37 @@ def subscribe_requestor_to_target():
     req = request.get_json()
     if req is None:
         return respond_no_json_received()
-    try:
-        req_email = req["requestor"]
-        target_email = req["target"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="No email addresses received (JSON keys should be 'requestor'"
-            "and 'target' for respective email addresses)"
-        )
-    if (not is_email_valid(req_email)) or (not is_email_valid(target_email)):
-        return respond_invalid_email_received()
+    if app.config["WRITE_COALESCING_ENABLED"]:
+        return respond_coalesced_write(write_subscriptions, req)
+    emails, error = parse_requestor_target_request(req)
+    if error is not None:
+        return respond_error(error)
+    req_email, target_email = emails
     with connect_to_db() as conn:
-        if not (does_email_exist(conn, req_email)
-            and does_email_exist(conn, target_email)
-        ):
-            return create_json_response(is_success=False,
-                error="One or both of the provided emails does not exist."
-            )
-        # if requestor has blocked target, do not create subscription
-        elif are_users_blocking(conn, blocker=req_email, blocked=target_email):
-            return create_json_response(is_success=False,
-                error="Requestor has blocked target, please unblock first"
+        email_ids = get_email_ids(conn, (req_email, target_email))
+        req_id, target_id = email_ids[req_email], email_ids[target_email]
+        if req_id is None or target_id is None:
+            return respond_error(ErrorMessages.EMAILS_NOT_FOUND)
+        pair_conn = pair_db(req_id, target_id)
+        ensure_email_rows(pair_conn, (req_id, target_id))
+        params = (req_id, target_id) * 2
+        try:
+            failed_checks = write_if_allowed(pair_conn,
+                SqlQueries.SUBSCRIBE_IF_ALLOWED, SqlQueries.DIAGNOSE_SUBSCRIBE,
+                params
             )
+        except sqlite3.IntegrityError:
+            return respond_error(ErrorMessages.INTEGRITY_ERROR)
+        if failed_checks is None:
+            sync_mirrors([(req_id, target_id)])
+            publish_edge_changes("subscription", [(req_id, target_id)], True)
+            return respond_success()
+        # if requestor has blocked target, no subscription was created
+        is_blocking, is_subscribed = failed_checks
+        if is_blocking:
+            return respond_error(ErrorMessages.REQUESTOR_BLOCKING)
         else:
-            try:
-                cur = conn.cursor()
-                cur.execute(SqlQueries.SUBSCRIBE_USER_TO_TARGET,
-                    (req_email, target_email)
-                )
-                conn.commit()
-                return respond_success()
-            except sqlite3.IntegrityError as err:
-                message = err.args[0]
-                if "unique constraint" in message.lower():
-                    return create_json_response(is_success=False,
-                        error="User already subscribed"
-                    )
-                else:
-                    return create_json_response(is_success=False,
-                        error="Unexpected SQLite integrity error"
-                    )
+            return respond_error(ErrorMessages.ALREADY_SUBSCRIBED)
 
 
 @app.post("/unsubscribe")
@@ -432,22 +2675,22 @@ def unsubscribe_requestor_from_target():
     req = request.get_json()
     if req is None:
         return respond_no_json_received()
-    try:
-        req_email = req["requestor"]
-        target_email = req["target"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="No email addresses received (JSON keys should be 'requestor'"
-            "and 'target' for respective email addresses)"
-        )
-    if (not is_email_valid(req_email)) or (not is_email_valid(target_email)):
-        return respond_invalid_email_received()
+    if app.config["WRITE_COALESCING_ENABLED"]:
+        return respond_coalesced_write(write_unsubscriptions, req)
+    emails, error = parse_requestor_target_request(req)
+    if error is not None:
+        return respond_error(error)
+    req_email, target_email = emails
     with connect_to_db() as conn:
-        cur = conn.cursor()
-        cur.execute(SqlQueries.UNSUBSCRIBE_USER_FROM_TARGET,
-            (req_email, target_email)
-        )
-        conn.commit()
+        email_ids = get_email_ids(conn, (req_email, target_email))
+        req_id, target_id = email_ids[req_email], email_ids[target_email]
+        if req_id is not None and target_id is not None:
+            pair_conn = pair_db(req_id, target_id)
+            cur = pair_conn.cursor()
+            cur.execute(SqlQueries.UNSUBSCRIBE_USER_FROM_TARGET, (req_id, target_id))
+            pair_conn.commit()
+            sync_mirrors([(req_id, target_id)])
+            publish_edge_changes("subscription", [(req_id, target_id)], False)
         return respond_success()
 
 
@@ -456,50 +2699,39 @@ def block_target_by_requestor():
     req = request.get_json()
     if req is None:
         return respond_no_json_received()
-    try:
-        req_email = req["requestor"]
-        target_email = req["target"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="No email addresses received (JSON keys should be 'requestor'"
-            "and 'target' for respective email addresses)"
-        )
-    if (not is_email_valid(req_email)) or (not is_email_valid(target_email)):
-        return respond_invalid_email_received()
+    if app.config["WRITE_COALESCING_ENABLED"]:
+        return respond_coalesced_write(write_blocks, req)
+    emails, error = parse_requestor_target_request(req)
+    if error is not None:
+        return respond_error(error)
+    req_email, target_email = emails
     with connect_to_db() as conn:
-        if not (does_email_exist(conn, req_email)
-            and does_email_exist(conn, target_email)
-        ):
-            return create_json_response(is_success=False,
-                error="One or both of the provided emails does not exist."
-            )
-        if are_users_friends(conn, req_email, target_email):
-            return create_json_response(is_success=False,
-                error="Users are friends (unfriend the target first)"
-            )
-        if is_user_subscribed(conn, req_email, target_email):
-            return create_json_response(is_success=False,
-                error="Requestor is subscribed to target (unsubscribe from "
-                "target first)"
+        email_ids = get_email_ids(conn, (req_email, target_email))
+        req_id, target_id = email_ids[req_email], email_ids[target_email]
+        if req_id is None or target_id is None:
+            return respond_error(ErrorMessages.EMAILS_NOT_FOUND)
+        pair_conn = pair_db(req_id, target_id)
+        ensure_email_rows(pair_conn, (req_id, target_id))
+        params = (req_id, target_id, *friend_edge(req_id, target_id),
+            req_id, target_id
+        )
+        try:
+            failed_checks = write_if_allowed(pair_conn,
+                SqlQueries.BLOCK_IF_ALLOWED, SqlQueries.DIAGNOSE_BLOCK, params
             )
+        except sqlite3.IntegrityError:
+            return respond_error(ErrorMessages.INTEGRITY_ERROR)
+        if failed_checks is None:
+            sync_mirrors([(req_id, target_id)])
+            publish_edge_changes("block", [(req_id, target_id)], True)
+            return respond_success()
+        is_blocking, is_friend, is_subscribed = failed_checks
+        if is_friend:
+            return respond_error(ErrorMessages.USERS_FRIENDS)
+        elif is_subscribed:
+            return respond_error(ErrorMessages.REQUESTOR_SUBSCRIBED)
         else:
-            try:
-                cur = conn.cursor()
-                cur.execute(SqlQueries.BLOCK_USER_TARGET,
-                    (req_email, target_email)
-                )
-                conn.commit()
-                return respond_success()
-            except sqlite3.IntegrityError as err:
-                message = err.args[0]
-                if "unique constraint" in message.lower():
-                    return create_json_response(is_success=False,
-                        error="User already blocked target"
-                    )
-                else:
-                    return create_json_response(is_success=False,
-                        error="Unexpected SQLite integrity error"
-                    )
+            return respond_error(ErrorMessages.ALREADY_BLOCKED)
 
 
 @app.post("/unblock")
@@ -507,22 +2739,22 @@ def unblock_target_by_requestor():
     req = request.get_json()
     if req is None:
         return respond_no_json_received()
-    try:
-        req_email = req["requestor"]
-        target_email = req["target"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="No email addresses received (JSON keys should be 'requestor'"
-            "and 'target' for respective email addresses)"
-        )
-    if (not is_email_valid(req_email)) or (not is_email_valid(target_email)):
-        return respond_invalid_email_received()
+    if app.config["WRITE_COALESCING_ENABLED"]:
+        return respond_coalesced_write(write_unblocks, req)
+    emails, error = parse_requestor_target_request(req)
+    if error is not None:
+        return respond_error(error)
+    req_email, target_email = emails
     with connect_to_db() as conn:
-        cur = conn.cursor()
-        cur.execute(SqlQueries.UNBLOCK_USER_TARGET,
-            (req_email, target_email)
-        )
-        conn.commit()
+        email_ids = get_email_ids(conn, (req_email, target_email))
+        req_id, target_id = email_ids[req_email], email_ids[target_email]
+        if req_id is not None and target_id is not None:
+            pair_conn = pair_db(req_id, target_id)
+            cur = pair_conn.cursor()
+            cur.execute(SqlQueries.UNBLOCK_USER_TARGET, (req_id, target_id))
+            pair_conn.commit()
+            sync_mirrors([(req_id, target_id)])
+            publish_edge_changes("block", [(req_id, target_id)], False)
         return respond_success()
 
 
@@ -534,26 +2766,765 @@ def get_recipients_of_update():
     try:
         sender_email = req["sender"]
         text = req["text"]
-    except KeyError:
-        return create_json_response(is_success=False,
-            error="JSON keys should be 'sender' for sender email and 'text' "
-            "for message text"
-        )
+    except (KeyError, TypeError):
+        return respond_error(ErrorMessages.NO_SENDER_TEXT)
     if not is_email_valid(sender_email):
         return respond_invalid_email_received()
-    mentions = re.findall(EMAIL_REGEX, text)
+    if not isinstance(text, str):
+        return respond_error(ErrorMessages.NO_SENDER_TEXT)
+    mentions = find_mentions(text)
+    ids = bool(req.get("ids", False))
     
     with connect_to_db() as conn:
-        if not does_email_exist(conn, sender_email):
-            return create_json_response(is_success=False,
-                error="Sender email does not exist"
+        sender_id = get_email_id(conn, sender_email)
+        if sender_id is None:
+            return respond_error(ErrorMessages.SENDER_NOT_FOUND)
+        graph = get_graph()
+        if graph is not None or ids:
+            mention_ids = [email_id
+                for email_id in get_email_ids(conn, mentions).values()
+                if email_id is not None
+            ]
+        if graph is not None:
+            recipient_ids = graph.recipients(sender_id, mention_ids)
+            if ids:
+                return create_json_response(is_success=True,
+                    recipient_ids=list(recipient_ids)
+                )
+            recipient_list = graph.to_emails(recipient_ids)
+        elif ids:
+            return create_json_response(is_success=True,
+                recipient_ids=get_recipient_ids(home_db(sender_id), sender_id,
+                    mention_ids
+                )
+            )
+        elif (app.config["RESULT_CACHE_ENABLED"] or app.config["SHARD_COUNT"] > 1
+            or app.config["CONCURRENT_READS_ENABLED"]
+        ):
+            # Mentioned users may have no email row on the sender's home shard,
+            # so mentions are looked up in the directory
+            audience, blockers = get_cached(("audience", sender_id), [sender_id],
+                lambda: get_audience(sender_id)
             )
-        notified_emails = (
-            set(get_friend_list(conn, sender_email))
-            .union(set(get_subscriber_list(conn, sender_email)))
-            .union(set((email for email in mentions if does_email_exist(conn, email))))
+            mention_ids = get_email_ids(conn, mentions)
+            recipient_list = list(audience.union(
+                email for email, email_id in mention_ids.items()
+                if email_id is not None and email not in blockers
+            ))
+        else:
+            recipient_list = get_recipient_list(conn, sender_id, mentions)
+        return create_json_response(is_success=True,
+            recipients=recipient_list
+        )
+
+
+def run_writes(conn, writes):
+    """Run (write function, list of request bodies) pairs in one transaction;
+    returns the list of results of each.
+
+    A write function checks and applies its request bodies in order, against
+    the database as left by the earlier ones, and returns (list of result
+    dicts, publish), where publish applies the changes to in-memory state
+    once they are committed. Result dicts have the same keys and errors as
+    the single-request endpoint's JSON response.
+    
+    With SHARD_COUNT > 1, conn is not used: see run_sharded_writes.
+    """
+    if app.config["SHARD_COUNT"] > 1:
+        return run_sharded_writes(writes)
+    outcomes = _commit_writes(conn, writes)
+    for _, publish in outcomes:
+        publish()
+    return [results for results, _ in outcomes]
+
+
+def _commit_writes(conn, writes):
+    """Run writes as for run_writes in one transaction on conn; returns the
+    (results, publish) pair of each, for the caller to publish
+    """
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        outcomes = [write(conn, reqs) for write, reqs in writes]
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        # Ids of emails added by the rolled back writes may have been cached
+        email_id_cache.clear()
+        raise
+    return outcomes
+
+
+def run_sharded_writes(writes):
+    """Run writes as for run_writes across shards (see sharding.py).
+
+    New emails are added to the directory, then copied to their home shards.
+    Other request bodies are run, in order, in one transaction on the pair
+    shard of their users, and the changes then copied to the mirror shards.
+    Bodies naming unknown users, or failing to parse, are run on the
+    directory, which reports the same errors as ever. Unlike with a single
+    shard, writes are only atomic per shard: if one shard fails, writes
+    already committed to others stay.
+    """
+    directory = connect_to_db()
+    all_results = []
+    for write, reqs in writes:
+        if write is write_emails:
+            (results, publish), = _commit_writes(directory, [(write, reqs)])
+            added = get_email_ids(directory, [parse_email_request(req)[0]
+                for req, result in zip(reqs, results) if result["success"]
+            ])
+            for email_id in added.values():
+                ensure_email_rows(home_db(email_id), [email_id])
+            publish()
+            all_results.append(results)
+            continue
+        parse_request = _WRITE_PARSERS[write]
+        parsed = {}
+        for i, req in enumerate(reqs):
+            emails, error = parse_request(req)
+            if error is None:
+                parsed[i] = emails[:2]
+        email_ids = get_email_ids(directory,
+            [email for emails in parsed.values() for email in emails]
+        )
+        # shard index -> indices of the request bodies to run there
+        by_shard = collections.defaultdict(list)
+        pairs = {}
+        for i in range(len(reqs)):
+            ids = [email_ids[email] for email in parsed.get(i, ())]
+            if ids and None not in ids:
+                pairs[i] = tuple(ids)
+                by_shard[sharding.pair_shard_of(*ids,
+                    app.config["SHARD_COUNT"]
+                )].append(i)
+            else:
+                by_shard[0].append(i)
+        results = [None] * len(reqs)
+        for index, indices in sorted(by_shard.items()):
+            shard_conn = connect_to_shard(index)
+            shard_pairs = [pairs[i] for i in indices if i in pairs]
+            ensure_email_rows(shard_conn,
+                {email_id for pair in shard_pairs for email_id in pair}
+            )
+            (shard_results, publish), = _commit_writes(shard_conn,
+                [(write, [reqs[i] for i in indices])]
+            )
+            for i, result in zip(indices, shard_results):
+                results[i] = result
+            sync_mirrors(shard_pairs)
+            publish()
+        all_results.append(results)
+    return all_results
+
+
+def write_emails(conn, reqs):
+    """Check and apply POST /users request bodies"""
+    results = [None] * len(reqs)
+    new_emails = {}
+    for i, req in enumerate(reqs):
+        email, error = parse_email_request(req)
+        if error is not None:
+            results[i] = {"success": False, "error": error}
+        else:
+            new_emails.setdefault(email, []).append(i)
+    existing = get_email_ids(conn, new_emails)
+    for email, indices in new_emails.items():
+        first = 0 if existing[email] is None else None
+        for n, i in enumerate(indices):
+            if n == first:
+                results[i] = {"success": True}
+            else:
+                results[i] = {"success": False, "error": ErrorMessages.EMAIL_EXISTS}
+    added = [email for email in new_emails if existing[email] is None]
+    cur = conn.cursor()
+    cur.executemany(SqlQueries.ADD_EMAIL, ((email,) for email in added))
+    cur.close()
+    # Drop the cached misses, so that later writes in the same transaction
+    # find the new emails
+    for email in added:
+        email_id_cache.invalidate(email)
+    
+    def publish():
+        for email in added:
+            email_id_cache.invalidate(email)
+        graph = get_graph()
+        if graph is not None:
+            for email, email_id in get_email_ids(conn, added).items():
+                graph.add_email(email_id, email)
+    
+    return results, publish
+
+
+def write_friends(conn, reqs):
+    """Check and apply POST /friend request bodies"""
+    results = [None] * len(reqs)
+    requested = {}
+    for i, req in enumerate(reqs):
+        emails, error = parse_friends_request(req)
+        if error is not None:
+            results[i] = {"success": False, "error": error}
+        else:
+            requested[i] = emails
+    email_ids = get_email_ids(conn,
+        [email for emails in requested.values() for email in emails]
+    )
+    edges = {}
+    for i, (email1, email2) in requested.items():
+        if email_ids[email1] is None or email_ids[email2] is None:
+            results[i] = {"success": False, "error": ErrorMessages.EMAILS_NOT_FOUND}
+        else:
+            edges[i] = friend_edge(email_ids[email1], email_ids[email2])
+    blocks = find_edges(conn, SqlQueries.FIND_BLOCKS,
+        [pair for id1, id2 in edges.values() for pair in ((id1, id2), (id2, id1))]
+    )
+    friends = find_edges(conn, SqlQueries.FIND_FRIENDS, edges.values())
+    added = []
+    for i, (id1, id2) in edges.items():
+        if (id1, id2) in blocks or (id2, id1) in blocks:
+            results[i] = {"success": False, "error": ErrorMessages.USERS_BLOCKING}
+        elif (id1, id2) in friends:
+            results[i] = {"success": False, "error": ErrorMessages.ALREADY_FRIENDS}
+        else:
+            friends.add((id1, id2))
+            added.append((id1, id2))
+            results[i] = {"success": True}
+    cur = conn.cursor()
+    cur.executemany(SqlQueries.ESTABLISH_FRIEND_CONNECTION, added)
+    cur.close()
+    return results, lambda: publish_edge_changes("friend", added, True)
+
+
+def _resolve_requestor_target_batch(conn, reqs, results):
+    """Parse a batch of requestor/target request bodies, filling in results
+    for invalid ones; returns dict of index -> (requestor id, target id)
+    """
+    requested = {}
+    for i, req in enumerate(reqs):
+        emails, error = parse_requestor_target_request(req)
+        if error is not None:
+            results[i] = {"success": False, "error": error}
+        else:
+            requested[i] = emails
+    email_ids = get_email_ids(conn,
+        [email for emails in requested.values() for email in emails]
+    )
+    edges = {}
+    for i, (req_email, target_email) in requested.items():
+        if email_ids[req_email] is None or email_ids[target_email] is None:
+            results[i] = {"success": False, "error": ErrorMessages.EMAILS_NOT_FOUND}
+        else:
+            edges[i] = (email_ids[req_email], email_ids[target_email])
+    return edges
+
+
+def write_subscriptions(conn, reqs):
+    """Check and apply POST /subscribe request bodies"""
+    results = [None] * len(reqs)
+    edges = _resolve_requestor_target_batch(conn, reqs, results)
+    blocks = find_edges(conn, SqlQueries.FIND_BLOCKS, edges.values())
+    subscriptions = find_edges(conn, SqlQueries.FIND_SUBSCRIPTIONS, edges.values())
+    added = []
+    for i, edge in edges.items():
+        if edge in blocks:
+            results[i] = {"success": False, "error": ErrorMessages.REQUESTOR_BLOCKING}
+        elif edge in subscriptions:
+            results[i] = {"success": False, "error": ErrorMessages.ALREADY_SUBSCRIBED}
+        else:
+            subscriptions.add(edge)
+            added.append(edge)
+            results[i] = {"success": True}
+    cur = conn.cursor()
+    cur.executemany(SqlQueries.SUBSCRIBE_USER_TO_TARGET, added)
+    cur.close()
+    return results, lambda: publish_edge_changes("subscription", added, True)
+
+
+def write_blocks(conn, reqs):
+    """Check and apply POST /block request bodies"""
+    results = [None] * len(reqs)
+    edges = _resolve_requestor_target_batch(conn, reqs, results)
+    friends = find_edges(conn, SqlQueries.FIND_FRIENDS,
+        [friend_edge(*edge) for edge in edges.values()]
+    )
+    subscriptions = find_edges(conn, SqlQueries.FIND_SUBSCRIPTIONS, edges.values())
+    blocks = find_edges(conn, SqlQueries.FIND_BLOCKS, edges.values())
+    added = []
+    for i, edge in edges.items():
+        if friend_edge(*edge) in friends:
+            results[i] = {"success": False, "error": ErrorMessages.USERS_FRIENDS}
+        elif edge in subscriptions:
+            results[i] = {"success": False, "error": ErrorMessages.REQUESTOR_SUBSCRIBED}
+        elif edge in blocks:
+            results[i] = {"success": False, "error": ErrorMessages.ALREADY_BLOCKED}
+        else:
+            blocks.add(edge)
+            added.append(edge)
+            results[i] = {"success": True}
+    cur = conn.cursor()
+    cur.executemany(SqlQueries.BLOCK_USER_TARGET, added)
+    cur.close()
+    return results, lambda: publish_edge_changes("block", added, True)
+
+
+def _remove_edges(conn, reqs, parse_request, to_edge, query, table):
+    """Check and apply request bodies removing edges from table; like the
+    single-request endpoints, these succeed whether or not the users and the
+    edge exist
+    """
+    results = [None] * len(reqs)
+    requested = []
+    for i, req in enumerate(reqs):
+        emails, error = parse_request(req)
+        if error is not None:
+            results[i] = {"success": False, "error": error}
+        else:
+            requested.append(emails[:2])
+            results[i] = {"success": True}
+    email_ids = get_email_ids(conn,
+        [email for emails in requested for email in emails]
+    )
+    removed = [to_edge(email_ids[email1], email_ids[email2])
+        for email1, email2 in requested
+        if email_ids[email1] is not None and email_ids[email2] is not None
+    ]
+    cur = conn.cursor()
+    cur.executemany(query, removed)
+    cur.close()
+    return results, lambda: publish_edge_changes(table, removed, False)
+
+
+def write_unfriends(conn, reqs):
+    """Check and apply POST /unfriend request bodies"""
+    return _remove_edges(conn, reqs, parse_friends_request, friend_edge,
+        SqlQueries.UNFRIEND, "friend"
+    )
+
+
+def write_unsubscriptions(conn, reqs):
+    """Check and apply POST /unsubscribe request bodies"""
+    return _remove_edges(conn, reqs, parse_requestor_target_request,
+        lambda req_id, target_id: (req_id, target_id),
+        SqlQueries.UNSUBSCRIBE_USER_FROM_TARGET, "subscription"
+    )
+
+
+def write_unblocks(conn, reqs):
+    """Check and apply POST /unblock request bodies"""
+    return _remove_edges(conn, reqs, parse_requestor_target_request,
+        lambda req_id, target_id: (req_id, target_id),
+        SqlQueries.UNBLOCK_USER_TARGET, "block"
+    )
+
+
+# Parser of the request bodies of each write function other than write_emails
+_WRITE_PARSERS = {
+    write_friends: parse_friends_request,
+    write_subscriptions: parse_requestor_target_request,
+    write_blocks: parse_requestor_target_request,
+    write_unfriends: parse_friends_request,
+    write_unsubscriptions: parse_requestor_target_request,
+    write_unblocks: parse_requestor_target_request,
+}
+
+
+def bulk_add_emails(conn, reqs):
+    """Apply a batch of POST /users request bodies in one transaction"""
+    return run_writes(conn, [(write_emails, reqs)])[0]
+
+
+def bulk_add_friends(conn, reqs):
+    """Apply a batch of POST /friend request bodies in one transaction"""
+    return run_writes(conn, [(write_friends, reqs)])[0]
+
+
+def bulk_subscribe(conn, reqs):
+    """Apply a batch of POST /subscribe request bodies in one transaction"""
+    return run_writes(conn, [(write_subscriptions, reqs)])[0]
+
+
+def bulk_block(conn, reqs):
+    """Apply a batch of POST /block request bodies in one transaction"""
+    return run_writes(conn, [(write_blocks, reqs)])[0]
+
+
+def apply_coalesced_writes(writes):
+    """Apply a batch of (write function, request body) pairs from the write
+    coalescer in one transaction; consecutive requests to the same endpoint
+    are checked and applied together
+    """
+    with app.app_context():
+        results = run_writes(connect_to_db(), [
+            (write, [req for _, req in group])
+            for write, group in itertools.groupby(writes, key=lambda item: item[0])
+        ])
+    return list(itertools.chain.from_iterable(results))
+
+
+write_coalescer = write_coalescing.WriteCoalescer(apply_coalesced_writes,
+    app.config["WRITE_BATCH_MAX_SIZE"], app.config["WRITE_BATCH_MAX_DELAY"]
+)
+
+registry.gauge_collector("write_coalescer",
+    "Write coalescer counters, by statistic", "stat", write_coalescer.stats
+)
+
+
+def respond_coalesced_write(write, req):
+    """Apply one request body through the write coalescer and respond with
+    its result
+    """
+    result = dict(write_coalescer.submit((write, req)).result())
+    return create_json_response(is_success=result.pop("success"), **result)
+
+
+def parse_ndjson(lines):
+    """Yield (1-based line number, parsed JSON) for each non-blank line"""
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            # Not a dict, so fails request parsing like a missing key would
+            yield line_number, None
+
+
+def apply_in_batches(conn, apply_batch, reqs, batch_size):
+    """Apply (line number, request body) pairs in batches of batch_size,
+    yielding (line number, result dict) for each
+    """
+    batch = []
+    line_numbers = []
+    for line_number, req in reqs:
+        batch.append(req)
+        line_numbers.append(line_number)
+        if len(batch) >= batch_size:
+            yield from zip(line_numbers, apply_batch(conn, batch))
+            batch, line_numbers = [], []
+    if batch:
+        yield from zip(line_numbers, apply_batch(conn, batch))
+
+
+def respond_bulk_results(apply_batch):
+    """Stream results of applying an NDJSON request body, one JSON object per
+    line, as the body is read
+    """
+    conn = connect_to_db()
+    
+    def generate():
+        results = apply_in_batches(conn, apply_batch,
+            parse_ndjson(request.stream), app.config["BULK_BATCH_SIZE"]
         )
-        notified_emails = notified_emails - set(get_blocker_list(conn, sender_email))
+        for line_number, result in results:
+            yield json.dumps({"line": line_number, **result}) + "\n"
+    
+    return Response(stream_with_db(generate()),
+        mimetype="application/x-ndjson"
+    )
+
+
+@app.post("/users/bulk")
+def add_emails_in_bulk():
+    return respond_bulk_results(bulk_add_emails)
+
+
+@app.post("/friend/bulk")
+def add_friends_in_bulk():
+    return respond_bulk_results(bulk_add_friends)
+
+
+@app.post("/subscribe/bulk")
+def subscribe_in_bulk():
+    return respond_bulk_results(bulk_subscribe)
+
+
+@app.post("/block/bulk")
+def block_in_bulk():
+    return respond_bulk_results(bulk_block)
+
+
+def bulk_find_recipients(conn, reqs):
+    """Find the recipients for a batch of GET /notified request bodies.
+
+    Mentions are found in one pass over all texts and all emails resolved in
+    one query, and each distinct sender's audience is looked up only once.
+    """
+    results = [None] * len(reqs)
+    requested = {}
+    for i, req in enumerate(reqs):
+        try:
+            sender_email, text = req["sender"], req["text"]
+        except (KeyError, TypeError):
+            results[i] = {"success": False, "error": ErrorMessages.NO_SENDER_TEXT}
+            continue
+        if not is_email_valid(sender_email):
+            results[i] = {"success": False, "error": ErrorMessages.INVALID_EMAIL}
+        elif not isinstance(text, str):
+            results[i] = {"success": False, "error": ErrorMessages.NO_SENDER_TEXT}
+        else:
+            requested[i] = (sender_email, text)
+    all_mentions = find_mentions_in_texts([text for _, text in requested.values()])
+    email_ids = get_email_ids(conn,
+        {sender_email for sender_email, _ in requested.values()}.union(*all_mentions)
+    )
+    graph = get_graph()
+    audiences = {}
+    for (i, (sender_email, _)), mentions in zip(requested.items(), all_mentions):
+        sender_id = email_ids[sender_email]
+        if sender_id is None:
+            results[i] = {"success": False, "error": ErrorMessages.SENDER_NOT_FOUND}
+            continue
+        if graph is not None:
+            recipient_list = graph.to_emails(graph.recipients(sender_id,
+                [email_ids[email] for email in mentions if email_ids[email] is not None]
+            ))
+        else:
+            if sender_id not in audiences:
+                audiences[sender_id] = get_cached(("audience", sender_id),
+                    [sender_id], lambda: get_audience(sender_id)
+                )
+            audience, blockers = audiences[sender_id]
+            recipient_list = list(audience.union(
+                email for email in mentions
+                if email_ids[email] is not None and email not in blockers
+            ))
+        results[i] = {"success": True, "recipients": recipient_list}
+    return results
+
+
+@app.post("/notified/batch")
+def get_recipients_of_updates():
+    if request.mimetype == "application/x-ndjson":
+        return respond_bulk_results(bulk_find_recipients)
+    reqs = request.get_json()
+    if reqs is None:
+        return respond_no_json_received()
+    if not isinstance(reqs, list):
+        return respond_error(ErrorMessages.NO_MESSAGES)
+    with connect_to_db() as conn:
         return create_json_response(is_success=True,
-            recipients=list(notified_emails)
-        )
\ No newline at end of file
+            results=bulk_find_recipients(conn, reqs)
+        )
+
+
+@app.cli.command("check-query-plans")
+def check_query_plans():
+    """Check that no SqlQueries statement scans a table"""
+    conn = connect_to_db()
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table';")
+    tables = {item[0] for item in cur.fetchall()}
+    cur.close()
+    scans = []
+    for name, query in vars(SqlQueries).items():
+        if not name.isupper():
+            continue
+        # Any value will do for the plan; '[]' also satisfies json_each
+        params = ("[]",) * query.count("?")
+        cur = conn.cursor()
+        try:
+            cur.execute("EXPLAIN QUERY PLAN " + query, params)
+        except sqlite3.OperationalError as err:
+            # e.g. the optional audience table has not been created
+            click.echo(f"{name}: skipped ({err})")
+            cur.close()
+            continue
+        for row in cur.fetchall():
+            # e.g. "SCAN friend" or "SCAN friend USING COVERING INDEX ...", but
+            # not scans of subqueries, constant rows or json_each
+            words = row[-1].split()
+            if words[0] == "SCAN" and words[1] in tables:
+                scans.append(f"{name}: {row[-1]}")
+        cur.close()
+    for scan in scans:
+        click.echo(scan, err=True)
+    if scans:
+        raise SystemExit(1)
+    click.echo("No table scans found")
+
+
+BULK_IMPORTERS = {
+    # kind: (batch function, CSV row -> request body)
+    "users": (bulk_add_emails, lambda row: dict(zip(("email",), row))),
+    "friend": (bulk_add_friends, lambda row: {"friends": row}),
+    "subscribe": (bulk_subscribe,
+        lambda row: dict(zip(("requestor", "target"), row))
+    ),
+    "block": (bulk_block, lambda row: dict(zip(("requestor", "target"), row))),
+}
+
+
+@app.cli.command("bulk-import")
+@click.argument("kind", type=click.Choice(list(BULK_IMPORTERS)))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=50000, show_default=True)
+def bulk_import(kind, path, batch_size):
+    """Load users or relationships from a CSV or NDJSON file into the database.
+
+    NDJSON lines are the request bodies of the matching endpoint. CSV files
+    have no header, and one email per column: email for users, and the two
+    emails in request order for the others. Rows are checked exactly like
+    requests to the endpoint; rejected rows are reported on stderr.
+    """
+    apply_batch, to_request = BULK_IMPORTERS[kind]
+    conn = connect_to_db()
+    # Nothing is lost on a crash that the import cannot simply redo
+    synchronous = conn.execute("PRAGMA synchronous;").fetchone()[0]
+    conn.execute("PRAGMA synchronous = OFF;")
+    counts = collections.Counter()
+    try:
+        with open(path, newline="") as f:
+            if path.endswith(".csv"):
+                reqs = ((line_number, to_request(row))
+                    for line_number, row in enumerate(csv.reader(f), start=1)
+                )
+            else:
+                reqs = parse_ndjson(f)
+            for line_number, result in apply_in_batches(conn, apply_batch, reqs,
+                batch_size
+            ):
+                counts[result["success"]] += 1
+                if not result["success"]:
+                    click.echo(f"{path}:{line_number}: {result['error']}", err=True)
+    finally:
+        conn.execute(f"PRAGMA synchronous = {synchronous};")
+    trim_change_logs(app.config["CHANGE_LOG_KEEP"])
+    click.echo(f"Imported {counts[True]} rows, rejected {counts[False]}")
+
+
+@app.cli.command("rebuild-audience")
+@click.option("--check", is_flag=True,
+    help="Only compare the audience table with the relationship tables."
+)
+@click.option("--drop", is_flag=True,
+    help="Drop the audience table and its triggers."
+)
+def rebuild_audience(check, drop):
+    """Create and fill the audience table used with AUDIENCE_TABLE_ENABLED,
+    then check it against the relationship tables, on every shard.
+    """
+    is_consistent = True
+    for index, conn in enumerate(shard_connections()):
+        shard = f" on shard {index}" if app.config["SHARD_COUNT"] > 1 else ""
+        if drop:
+            conn.execute("BEGIN IMMEDIATE;")
+            for statement in DROP_AUDIENCE:
+                conn.execute(statement)
+            conn.commit()
+            click.echo(f"Dropped the audience table{shard}")
+            continue
+        if not check:
+            conn.execute("BEGIN IMMEDIATE;")
+            for statement in AUDIENCE_SCHEMA:
+                conn.execute(statement)
+            conn.execute("DELETE FROM audience;")
+            cur = conn.execute("INSERT INTO audience " + LIVE_AUDIENCE + ";")
+            conn.commit()
+            click.echo(f"Wrote {cur.rowcount} audience rows{shard}")
+        missing = conn.execute(
+            f"SELECT COUNT(*) FROM ({LIVE_AUDIENCE} EXCEPT SELECT * FROM audience);"
+        ).fetchone()[0]
+        unexpected = conn.execute(
+            f"SELECT COUNT(*) FROM (SELECT * FROM audience EXCEPT {LIVE_AUDIENCE});"
+        ).fetchone()[0]
+        if missing or unexpected:
+            click.echo(f"Audience table differs{shard}: {missing} rows missing, "
+                f"{unexpected} unexpected", err=True
+            )
+            is_consistent = False
+        else:
+            click.echo(f"Audience table is consistent{shard}")
+    if not is_consistent:
+        raise SystemExit(1)
+
+
+@app.cli.command("build-snapshot")
+@click.argument("path", type=click.Path(dir_okay=False))
+def build_snapshot(path):
+    """Write a snapshot of the relationship tables for GRAPH_SNAPSHOT_PATH.
+
+    The server only uses the snapshot while no change has been made to the
+    database since it was written, so take it after the last writes.
+    """
+    if app.config["SHARD_COUNT"] > 1:
+        click.echo("Snapshots are not supported with SHARD_COUNT > 1", err=True)
+        raise SystemExit(1)
+    counts = csr_snapshot.write_snapshot(connect_to_db(), path)
+    click.echo(f"Wrote {counts['email']} emails, {counts['friend']} friendships, "
+        f"{counts['subscription']} subscriptions and {counts['block']} blocks "
+        f"to {path}"
+    )
+
+
+@app.cli.command("trim-change-log")
+@click.option("--keep", default=100000, show_default=True,
+    type=click.IntRange(min=1), help="Number of latest changes to keep."
+)
+def trim_change_log(keep):
+    """Delete all but the latest changes from change_log.
+
+    A server process that has not yet synced the deleted changes drops its
+    caches instead (see CHANGE_LOG_SYNC_ENABLED), so keep more changes than
+    are committed between two requests to any one process. Servers trim it
+    themselves every CHANGE_LOG_TRIM_EVERY write requests.
+    """
+    click.echo(f"Deleted {trim_change_logs(keep)} changes")
+
+
+@app.cli.command("reshard")
+@click.argument("shard_count", type=click.IntRange(min=1))
+@click.argument("path", type=click.Path(dir_okay=False))
+def reshard(shard_count, path):
+    """Copy the database into SHARD_COUNT new shard files at PATH (e.g.
+    users.db, users.shard1.db, ...) for use with SHARD_COUNT.
+
+    The current files are left as they are. Copy while no writes are made,
+    then point DB_PATH and SHARD_COUNT at the new files.
+    """
+    schema = runpy.run_path(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "db-structure.py"),
+        run_name="db_structure"
+    )
+    try:
+        counts = sharding.write_shards(shard_connections(), path, shard_count,
+            schema["SCHEMA"], SCHEMA_VERSION
+        )
+    except FileExistsError as err:
+        click.echo(str(err), err=True)
+        raise SystemExit(1)
+    for shard_path, shard_counts in zip(sharding.shard_paths(path, shard_count),
+        counts
+    ):
+        click.echo(f"Wrote {shard_counts['email']} emails, "
+            f"{shard_counts['friend']} friendships, "
+            f"{shard_counts['subscription']} subscriptions and "
+            f"{shard_counts['block']} blocks to {shard_path}"
+        )
+
+
+@app.cli.command("sync-shards")
+def sync_shards():
+    """Copy every user's email row to their home shard, and every
+    relationship from its pair shard to its mirror shard, where missing or
+    different; repairs shards after a server failed between the two writes.
+    """
+    shard_count = app.config["SHARD_COUNT"]
+    directory = connect_to_db()
+    email_ids = [item[0] for item in directory.execute("SELECT email_id FROM email;")]
+    by_home = collections.defaultdict(list)
+    for email_id in email_ids:
+        by_home[sharding.shard_of(email_id, shard_count)].append(email_id)
+    for index, home_ids in by_home.items():
+        ensure_email_rows(connect_to_shard(index), home_ids)
+    pairs = set()
+    for conn in shard_connections():
+        for table, columns in sharding.RELATIONSHIP_TABLES.items():
+            for pair in conn.execute(
+                f"SELECT {columns[0]}, {columns[1]} FROM {table};"
+            ):
+                # Mirrors of pairs deleted on the pair shard are found too
+                pairs.add(friend_edge(*pair))
+    changed = sync_mirrors(pairs)
+    click.echo(f"Checked {len(email_ids)} emails and {len(pairs)} pairs of "
+        f"users on {shard_count} shards, changed {changed} rows"
+    )
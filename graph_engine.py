@@ -0,0 +1,314 @@
+"""In-memory copy of the friend, subscription and block graph.
+
+The graph is keyed by email_id and is loaded once from users.db. The server
+keeps it up to date by applying each write after it has been committed to
+SQLite, so SQLite always remains the source of truth.
+"""
+import bisect
+import threading
+
+
+class SocialGraph:
+    """Adjacency sets for every relationship table, plus the email strings"""
+    def __init__(self):
+        self.emails = {}       # email_id -> email
+        self.friends = {}      # email_id -> set of friends' email_ids
+        self.subscribers = {}  # target email_id -> set of subscriber email_ids
+        self.blockers = {}     # blocked email_id -> set of blocker email_ids
+        # email_ids of users being deleted, left out of every result while
+        # their relationships are removed
+        self.hidden = set()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_db(cls, *conns):
+        """Load the graph from a database, or from all shards of a sharded one
+        (see sharding.py), whose rows may be stored on more than one shard
+        """
+        graph = cls()
+        for conn in conns:
+            cur = conn.cursor()
+            cur.execute("SELECT email_id, email FROM email;")
+            graph.emails.update(cur.fetchall())
+            cur.execute("SELECT email_id1, email_id2 FROM friend;")
+            for email_id1, email_id2 in cur:
+                graph.add_friend(email_id1, email_id2)
+            cur.execute("SELECT subscriber_email_id, target_email_id FROM subscription;")
+            for subscriber_id, target_id in cur:
+                graph.add_subscription(subscriber_id, target_id)
+            cur.execute("SELECT blocker_email_id, blocked_email_id FROM block;")
+            for blocker_id, blocked_id in cur:
+                graph.add_block(blocker_id, blocked_id)
+            cur.close()
+        return graph
+
+    @staticmethod
+    def _link(adjacency, key, value):
+        adjacency.setdefault(key, set()).add(value)
+
+    @staticmethod
+    def _unlink(adjacency, key, value):
+        neighbours = adjacency.get(key)
+        if neighbours is not None:
+            neighbours.discard(value)
+            if not neighbours:
+                del adjacency[key]
+
+    def add_email(self, email_id, email):
+        with self._lock:
+            # The email_id of a deleted user may be handed out again
+            self.hidden.discard(email_id)
+            self.emails[email_id] = email
+
+    def remove_user(self, email_id):
+        """Leave a user out of every result from now on; their edges are
+        kept until removed one by one, as the database's are
+        """
+        with self._lock:
+            self.hidden.add(email_id)
+            self.emails.pop(email_id, None)
+
+    def add_friend(self, email_id1, email_id2):
+        with self._lock:
+            self._link(self.friends, email_id1, email_id2)
+            self._link(self.friends, email_id2, email_id1)
+
+    def remove_friend(self, email_id1, email_id2):
+        with self._lock:
+            self._unlink(self.friends, email_id1, email_id2)
+            self._unlink(self.friends, email_id2, email_id1)
+
+    def add_subscription(self, subscriber_id, target_id):
+        with self._lock:
+            self._link(self.subscribers, target_id, subscriber_id)
+
+    def remove_subscription(self, subscriber_id, target_id):
+        with self._lock:
+            self._unlink(self.subscribers, target_id, subscriber_id)
+
+    def add_block(self, blocker_id, blocked_id):
+        with self._lock:
+            self._link(self.blockers, blocked_id, blocker_id)
+
+    def remove_block(self, blocker_id, blocked_id):
+        with self._lock:
+            self._unlink(self.blockers, blocked_id, blocker_id)
+
+    def to_emails(self, email_ids):
+        """Emails of email_ids, None for users removed since the ids were read"""
+        with self._lock:
+            return [self.emails.get(email_id) for email_id in email_ids]
+
+    def friends_of(self, email_id):
+        with self._lock:
+            return self.friends.get(email_id, set()).difference(self.hidden)
+
+    def subscribers_of(self, email_id):
+        with self._lock:
+            return self.subscribers.get(email_id, set()).difference(self.hidden)
+
+    def is_blocking(self, blocker_id, blocked_id):
+        with self._lock:
+            return blocker_id in self.blockers.get(blocked_id, ())
+
+    def common_friends(self, email_ids):
+        with self._lock:
+            # Intersect starting from the smallest friend set
+            neighbour_sets = sorted(
+                (self.friends.get(email_id, set()) for email_id in email_ids),
+                key=len,
+            )
+            return (neighbour_sets[0].intersection(*neighbour_sets[1:])
+                .difference(self.hidden)
+            )
+
+    def recipients(self, sender_id, mention_ids=()):
+        """Friends, subscribers and mentioned users of sender, less users
+        who block sender
+        """
+        with self._lock:
+            return (
+                self.friends.get(sender_id, set())
+                .union(self.subscribers.get(sender_id, ()), mention_ids)
+                .difference(self.blockers.get(sender_id, ()), self.hidden)
+            )
+
+    def _edges(self):
+        """Set of (table, email_id, email_id) rows in users.db format"""
+        with self._lock:
+            edges = set()
+            for email_id, friend_ids in self.friends.items():
+                edges.update(("friend", email_id, friend_id)
+                    for friend_id in friend_ids if email_id < friend_id
+                )
+            for target_id, subscriber_ids in self.subscribers.items():
+                edges.update(("subscription", subscriber_id, target_id)
+                    for subscriber_id in subscriber_ids
+                )
+            for blocked_id, blocker_ids in self.blockers.items():
+                edges.update(("block", blocker_id, blocked_id)
+                    for blocker_id in blocker_ids
+                )
+            return edges
+
+    def _email_items(self):
+        with self._lock:
+            return set(self.emails.items())
+
+    def diff(self, other):
+        """Compare with another graph; returns a dict of the rows and emails
+        present only in this graph ('missing') and only in the other graph
+        ('unexpected')
+        """
+        own_edges, other_edges = self._edges(), other._edges()
+        own_emails, other_emails = self._email_items(), other._email_items()
+        return {
+            "missing": sorted(
+                [("email", *item) for item in own_emails - other_emails]
+                + list(own_edges - other_edges)
+            ),
+            "unexpected": sorted(
+                [("email", *item) for item in other_emails - own_emails]
+                + list(other_edges - own_edges)
+            ),
+        }
+
+
+class SnapshotGraph(SocialGraph):
+    """SocialGraph reading from a memory-mapped snapshot (see csr_snapshot.py).
+
+    The snapshot is never modified: the inherited dicts hold only the emails
+    and edges added since it was written, and _removed the snapshot's edges
+    removed since.
+    """
+    def __init__(self, snapshot):
+        super().__init__()
+        self.snapshot = snapshot
+        self._removed = {"friends": {}, "subscribers": {}, "blockers": {}}
+
+    def _added(self, section):
+        return getattr(self, section)
+
+    def _has_in_snapshot(self, section, key, value):
+        neighbours = self.snapshot.neighbours(section, key)
+        i = bisect.bisect_left(neighbours, value)
+        return i < len(neighbours) and neighbours[i] == value
+
+    def _has(self, section, key, value):
+        in_snapshot = self._has_in_snapshot(section, key, value)
+        with self._lock:
+            if in_snapshot:
+                return value not in self._removed[section].get(key, ())
+            return value in self._added(section).get(key, ())
+
+    def _neighbours(self, section, key):
+        neighbours = set(self.snapshot.neighbours(section, key))
+        with self._lock:
+            neighbours.difference_update(self._removed[section].get(key, ()))
+            neighbours.update(self._added(section).get(key, ()))
+        return neighbours
+
+    def _add(self, section, key, value):
+        in_snapshot = self._has_in_snapshot(section, key, value)
+        with self._lock:
+            if in_snapshot:
+                self._unlink(self._removed[section], key, value)
+            else:
+                self._link(self._added(section), key, value)
+
+    def _remove(self, section, key, value):
+        in_snapshot = self._has_in_snapshot(section, key, value)
+        with self._lock:
+            if in_snapshot:
+                self._link(self._removed[section], key, value)
+            else:
+                self._unlink(self._added(section), key, value)
+
+    def add_friend(self, email_id1, email_id2):
+        with self._lock:
+            self._add("friends", email_id1, email_id2)
+            self._add("friends", email_id2, email_id1)
+
+    def remove_friend(self, email_id1, email_id2):
+        with self._lock:
+            self._remove("friends", email_id1, email_id2)
+            self._remove("friends", email_id2, email_id1)
+
+    def add_subscription(self, subscriber_id, target_id):
+        self._add("subscribers", target_id, subscriber_id)
+
+    def remove_subscription(self, subscriber_id, target_id):
+        self._remove("subscribers", target_id, subscriber_id)
+
+    def add_block(self, blocker_id, blocked_id):
+        self._add("blockers", blocked_id, blocker_id)
+
+    def remove_block(self, blocker_id, blocked_id):
+        self._remove("blockers", blocked_id, blocker_id)
+
+    def to_emails(self, email_ids):
+        with self._lock:
+            return [self.emails.get(email_id) or (
+                    None if email_id in self.hidden
+                    else self.snapshot.email(email_id)
+                )
+                for email_id in email_ids
+            ]
+
+    def _visible(self, email_ids):
+        with self._lock:
+            email_ids.difference_update(self.hidden)
+        return email_ids
+
+    def friends_of(self, email_id):
+        return self._visible(self._neighbours("friends", email_id))
+
+    def subscribers_of(self, email_id):
+        return self._visible(self._neighbours("subscribers", email_id))
+
+    def is_blocking(self, blocker_id, blocked_id):
+        return self._has("blockers", blocked_id, blocker_id)
+
+    def common_friends(self, email_ids):
+        neighbour_sets = sorted(
+            (self._neighbours("friends", email_id) for email_id in email_ids),
+            key=len,
+        )
+        return self._visible(neighbour_sets[0].intersection(*neighbour_sets[1:]))
+
+    def recipients(self, sender_id, mention_ids=()):
+        return self._visible(
+            self._neighbours("friends", sender_id)
+            .union(self._neighbours("subscribers", sender_id), mention_ids)
+            .difference(self._neighbours("blockers", sender_id))
+        )
+
+    def _edges(self):
+        edges = set()
+        for section, table in (
+            ("friends", "friend"), ("subscribers", "subscription"),
+            ("blockers", "block"),
+        ):
+            with self._lock:
+                keys = set(self.snapshot.keys(section)).union(self._added(section))
+            for key in keys:
+                for neighbour in self._neighbours(section, key):
+                    if section == "friends":
+                        if key < neighbour:
+                            edges.add(("friend", key, neighbour))
+                    else:
+                        # Sections are keyed by target / blocked user
+                        edges.add((table, neighbour, key))
+        return edges
+
+    def _email_items(self):
+        with self._lock:
+            # Emails added since the snapshot override its own, and hidden
+            # users' are gone
+            skipped = self.hidden.union(self.emails)
+            items = set(self.emails.items())
+        for email_id in range(self.snapshot.max_email_id + 1):
+            email = self.snapshot.email(email_id)
+            if email is not None and email_id not in skipped:
+                items.add((email_id, email))
+        return items
@@ -0,0 +1,96 @@
+"""Memory-bounded LRU cache of per-user results, invalidated by generations.
+
+Every cached result lists the users it depends on. Each user has a generation
+counter which write handlers bump after committing a change that affects that
+user, and a cached result is only used while the generations of all of its
+users are unchanged since it was computed. Invalidation is therefore exact,
+and costs one counter increment per affected user.
+"""
+import collections
+import sys
+import threading
+
+
+def estimate_size(value):
+    """Rough size in bytes of a result: strings, numbers and (possibly nested)
+    lists, tuples, sets and frozensets of them
+    """
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._generations = collections.defaultdict(int)
+        # Incremented by clear, so that results computed before it are dropped
+        self._epoch = 0
+        # key -> (value, size, ((user, generation), ...))
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+    def bump(self, *users):
+        """Invalidate every cached result depending on any of users"""
+        with self._lock:
+            for user in users:
+                self._generations[user] += 1
+
+    def clear(self):
+        """Invalidate every cached result, including those being computed"""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def _is_current(self, versions):
+        return all(self._generations[user] == generation
+            for user, generation in versions
+        )
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get_or_compute(self, key, users, compute):
+        """Get the cached result for key, or compute, cache and return it.
+
+        The generations of users are read before compute runs, so a write
+        committed while it runs leaves the new entry already stale instead of
+        caching a result that predates the write.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_current(entry[2]):
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[0]
+                self._remove(key)
+                self._stats["stale"] += 1
+            self._stats["misses"] += 1
+            versions = tuple((user, self._generations[user]) for user in users)
+            epoch = self._epoch
+        value = compute()
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            if epoch != self._epoch:
+                return value
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, versions)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries),
+                "bytes": self._bytes
+            }
@@ -0,0 +1,62 @@
+"""Profile a sample of requests with cProfile, for inspection offline.
+
+One in every N requests to each route is profiled, so that rare routes are
+sampled as well as busy ones, and each profile is written to a file of its
+own, e.g. to read with `python -m pstats FILE` or snakeviz.
+"""
+import cProfile
+import os
+import re
+import threading
+import time
+
+
+class SamplingProfiler:
+    def __init__(self, every, directory):
+        """Profile one in every `every` requests to each route, writing the
+        profiles to directory, which is created if missing
+        """
+        self.every = every
+        self.directory = directory
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "sampled": 0, "skipped": 0, "written": 0}
+
+    def start(self, method, route):
+        """Start profiling the current thread if this request is sampled;
+        returns the profile to pass to stop, or None
+        """
+        with self._lock:
+            self._stats["requests"] += 1
+            count = self._counts.get((method, route), 0)
+            self._counts[method, route] = count + 1
+            if count % self.every:
+                return None
+            self._stats["sampled"] += 1
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active on this thread
+            with self._lock:
+                self._stats["skipped"] += 1
+            return None
+        return profile
+
+    def stop(self, profile, method, route):
+        """Stop profile and write it to a file; returns the file's path"""
+        profile.disable()
+        name = re.sub(r"[^\w.-]+", "_", f"{method} {route}").strip("_")
+        os.makedirs(self.directory, exist_ok=True)
+        # e.g. GET_friend_list.1792250085713748500.4242.prof
+        path = os.path.join(self.directory,
+            f"{name}.{time.time_ns()}.{os.getpid()}.prof"
+        )
+        profile.dump_stats(path)
+        with self._lock:
+            self._stats["written"] += 1
+        return path
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,125 @@
+"""Partitioning of users and their relationships across SQLite files.
+
+Shard 0 is the database at DB_PATH. It is also the directory: the email table
+there holds every user and hands out email_ids. Each other user is at home on
+shard shard_of(email_id), which holds a copy of the user's email row. A
+relationship row between two users is stored on both of their home shards,
+along with a copy of the email row of whichever user is not at home there.
+Everything about one user can then be read from their home shard, and
+everything between two users from either one's home shard.
+
+Of the two shards, writes go to the pair shard, the home shard of the user
+with the smaller email_id, which checks and commits them. They are then
+copied to the mirror shard, the other user's home shard. The pair shard is
+the source of truth for a pair when the two disagree.
+"""
+import collections
+import os
+import sqlite3
+
+
+# Knuth's multiplicative hash, so that consecutive email_ids are spread out
+_HASH_MULTIPLIER = 2654435761
+
+
+def shard_of(email_id, shard_count):
+    """Index of the home shard of email_id"""
+    return (email_id * _HASH_MULTIPLIER) % 2 ** 32 % shard_count
+
+
+def pair_shard_of(email_id1, email_id2, shard_count):
+    """Index of the shard checking and committing writes between two users"""
+    return shard_of(min(email_id1, email_id2), shard_count)
+
+
+def shard_paths(db_path, shard_count):
+    """Paths of the shard files of the database at db_path, in shard order:
+    db_path itself, then e.g. users.shard1.db, users.shard2.db, ...
+    """
+    root, ext = os.path.splitext(db_path)
+    return [db_path] + [f"{root}.shard{i}{ext}" for i in range(1, shard_count)]
+
+
+# Relationship tables, and the columns holding the pair of users
+RELATIONSHIP_TABLES = {
+    "friend": ("email_id1", "email_id2"),
+    "subscription": ("subscriber_email_id", "target_email_id"),
+    "block": ("blocker_email_id", "blocked_email_id"),
+}
+
+
+def write_shards(sources, dest_path, shard_count, schema, schema_version):
+    """Write a copy of the database split into shard_count shards, at the
+    shard paths of dest_path; returns the number of rows written to each.
+
+    sources are connections to the shards of the existing database, in shard
+    order; each relationship is read from its pair shard only. schema lists
+    the statements creating an empty database at schema_version.
+    """
+    source_count = len(sources)
+    dest_paths = shard_paths(dest_path, shard_count)
+    for path in dest_paths:
+        if os.path.exists(path):
+            raise FileExistsError(f"{path} already exists")
+    dests = []
+    for path in dest_paths:
+        conn = sqlite3.connect(path)
+        for statement in schema:
+            conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {schema_version};")
+        dests.append(conn)
+    emails = dict(sources[0].execute("SELECT email_id, email FROM email;"))
+    # Every shard needs the deletions, to leave out users being deleted; the
+    # rows removed so far are all counted on the first
+    deletions = sources[0].execute(
+        "SELECT email_id, email, requested_at, finished_at FROM deletion;"
+    ).fetchall()
+    removed_rows = collections.Counter()
+    for source in sources:
+        removed_rows.update(dict(source.execute(
+            "SELECT email_id, removed_rows FROM deletion;"
+        )))
+    # email_id -> shards holding its email row
+    email_shards = {email_id: {0, shard_of(email_id, shard_count)}
+        for email_id in emails
+    }
+    rows = {table: [[] for _ in dests] for table in RELATIONSHIP_TABLES}
+    for source_index, source in enumerate(sources):
+        for table, columns in RELATIONSHIP_TABLES.items():
+            for pair in source.execute(
+                f"SELECT {columns[0]}, {columns[1]} FROM {table};"
+            ):
+                if pair_shard_of(*pair, source_count) != source_index:
+                    continue
+                for dest_index in {shard_of(email_id, shard_count) for email_id in pair}:
+                    rows[table][dest_index].append(pair)
+                    for email_id in pair:
+                        email_shards[email_id].add(dest_index)
+    counts = []
+    for dest_index, conn in enumerate(dests):
+        conn.executemany("INSERT INTO email (email_id, email) VALUES (?, ?);",
+            ((email_id, emails[email_id]) for email_id in sorted(emails)
+                if dest_index in email_shards[email_id]
+            )
+        )
+        counts.append({
+            "email": conn.execute("SELECT COUNT(*) FROM email;").fetchone()[0]
+        })
+        conn.executemany("INSERT INTO deletion (email_id, email, requested_at, "
+            "removed_rows, finished_at) VALUES (?, ?, ?, ?, ?);",
+            ((email_id, email, requested_at,
+                removed_rows[email_id] if dest_index == 0 else 0, finished_at)
+                for email_id, email, requested_at, finished_at in deletions
+            )
+        )
+        for table, columns in RELATIONSHIP_TABLES.items():
+            conn.executemany(
+                f"INSERT INTO {table} ({columns[0]}, {columns[1]}) VALUES (?, ?);",
+                rows[table][dest_index]
+            )
+            counts[-1][table] = len(rows[table][dest_index])
+        # Copying is not a change the servers need to follow
+        conn.execute("DELETE FROM change_log;")
+        conn.commit()
+        conn.close()
+    return counts
@@ -0,0 +1,88 @@
+"""Group commit: many threads submit writes, one thread applies them.
+
+Writes submitted close together in time are handed to the writer thread's
+apply_batch function together, so they can share one transaction (and one
+fsync) instead of each committing on its own.
+"""
+import concurrent.futures
+import queue
+import threading
+import time
+
+
+class WriteCoalescer:
+    def __init__(self, apply_batch, max_batch_size, max_delay):
+        """apply_batch is called on the writer thread with a list of submitted
+        items, and returns a list with the result of each. A batch is applied
+        once it holds max_batch_size items, or max_delay seconds after its
+        first item was taken from the queue. If applying a batch raises, its
+        items are applied again one at a time, so that only those raising
+        again fail.
+        """
+        self.apply_batch = apply_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "batches": 0, "failed_batches": 0,
+            "failed_items": 0
+        }
+
+    def submit(self, item):
+        """Queue item; returns a concurrent.futures.Future of its result"""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name="write-coalescer", daemon=True
+                )
+                self._thread.start()
+            self._stats["submitted"] += 1
+        self._queue.put((item, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.apply_batch([item for item, _ in batch])
+            except Exception:
+                # Every write in the batch was rolled back
+                with self._lock:
+                    self._stats["failed_batches"] += 1
+                for item, future in batch:
+                    self._apply_alone(item, future)
+                continue
+            with self._lock:
+                self._stats["batches"] += 1
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _apply_alone(self, item, future):
+        try:
+            result, = self.apply_batch([item])
+        except Exception as err:
+            with self._lock:
+                self._stats["failed_items"] += 1
+            future.set_exception(err)
+        else:
+            future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "queued": self._queue.qsize()}